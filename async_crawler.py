@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+import telemetry
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+
+class RateLimiter:
+    """
+    Spaces out request start times so that no more than `requests_per_second`
+    requests begin in any one second. A rate of 0 (or None) disables the limit.
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def _crawl(start_url, base_url, max_depth, fetch_links, workers, per_host, requests_per_second, stats, checkpoint=None):
+    """
+    Breadth-first crawl driven by a fixed pool of worker tasks.
+    The blocking `fetch_links(url, base_url)` call runs in a thread pool sized to the worker pool,
+    each host gets its own semaphore so no single host sees more than `per_host` requests in flight,
+    and all workers share one RateLimiter.
+    Pages at depth 0..max_depth are fetched, exactly like crawl_links.
+    With a catalog.CrawlCheckpoint, the links found and the pages still queued or in flight are saved
+    periodically, and a crawl that has a snapshot starts from it instead of from `start_url`.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+    limiter = RateLimiter(requests_per_second)
+
+    state = checkpoint.load() if checkpoint is not None else None
+    visited, frontier = state if state else (set(), [(start_url, 0)])
+    queued = {start_url} | {url for url, _ in frontier}
+    # Pages queued or in flight, in the order they were queued
+    pending = dict(frontier)
+    queue = asyncio.Queue()
+    for item in frontier:
+        queue.put_nowait(item)
+
+    async def worker():
+        while True:
+            url, depth = await queue.get()
+            try:
+                async with host_limits[urlparse(url).netloc]:
+                    await limiter.wait()
+                    links = await loop.run_in_executor(executor, fetch_links, url, base_url)
+                stats["fetched"] += 1
+                for link in links:
+                    if link in visited:
+                        stats["deduplicated"] += 1
+                        continue
+                    visited.add(link)
+                    # Links found on the deepest level are recorded but not fetched
+                    if depth >= max_depth:
+                        stats["skipped"] += 1
+                    elif link not in queued:
+                        queued.add(link)
+                        pending[link] = depth + 1
+                        queue.put_nowait((link, depth + 1))
+            except Exception as e:
+                telemetry.log(pyfilename, f"Error crawling {url}: {e}")
+            finally:
+                pending.pop(url, None)
+                if checkpoint is not None:
+                    checkpoint.tick(visited, pending.items())
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        executor.shutdown(wait=False)
+
+    if checkpoint is not None:
+        checkpoint.save(visited, [])
+    return visited
+
+
+def crawl_links_async(start_url, base_url, fetch_links, max_depth=2, workers=16, per_host=8, requests_per_second=10, stats=None,
+                      checkpoint=None):
+    """
+    Drop-in alternative to splashLearn.crawl_links that fetches many pages concurrently.
+    `fetch_links` is the function used to download a page and return its links (normally splashLearn.get_links).
+    Returns the same set of visited links as the sequential crawl.
+    If `stats` is given (see splashLearn.new_crawl_stats) it is updated with fetched/skipped/deduplicated counts.
+    `checkpoint` (a catalog.CrawlCheckpoint) makes the crawl resumable, as in crawl_links.
+    """
+    if stats is None:
+        stats = {"fetched": 0, "skipped": 0, "deduplicated": 0}
+    return asyncio.run(_crawl(start_url, base_url, max_depth, fetch_links,
+                              max(1, int(workers)), max(1, int(per_host)), requests_per_second, stats, checkpoint))
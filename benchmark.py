@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import shutil
+import argparse
+import tempfile
+import datetime
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fitz  # PyMuPDF
+import splashLearn
+import pdf_maker
+import pdf_store
+import request_layer
+import catalog as catalog_module
+import telemetry
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+SUBJECT = "math"
+TOPICS = ["ADDITION", "FRACTIONS", "GEOMETRY", "MEASUREMENT", "MULTIPLICATION", "TIME"]
+
+
+class StandInSite:
+    """
+    Local stand-in for www.splashlearn.com serving synthetic pages with the markup the crawler expects:
+      /<subject>-worksheets-for-<grade>-graders[/page/N]  listing pages, `per_page` worksheet links each
+      /s/<subject>-worksheets/<slug>                        worksheet pages (grade, subject and topic badges, a PDF link)
+      /worksheet_uploads/pdf/s/<slug>.pdf                   PDFs of `pdf_pages` pages, with an ETag
+    Every response is delayed by `latency` seconds, and a fraction `error_rate` of them are 503s.
+    Requests are counted per path kind in `requests`.
+    """
+
+    def __init__(self, grade="3rd", listing_pages=5, per_page=20, pdf_pages=2, latency=0.0, error_rate=0.0, seed=1):
+        self.grade = grade
+        self.listing_pages = listing_pages
+        self.per_page = per_page
+        self.pdf_pages = pdf_pages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.pdfs = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def worksheet_slugs(self, page):
+        first = (page - 1) * self.per_page
+        return [f"worksheet-{n}" for n in range(first, first + self.per_page)]
+
+    def listing_page(self, page):
+        links = "".join(f'<div class="card"><a href="/s/{SUBJECT}-worksheets/{slug}">{slug}</a></div>'
+                        for slug in self.worksheet_slugs(page))
+        pagination = "".join(f'<a href="/{SUBJECT}-worksheets-for-{self.grade}-graders/page/{n}">{n}</a>'
+                             for n in range(max(2, page - 2), min(self.listing_pages, page + 2) + 1))
+        return f"<html><body><h1>Worksheets</h1>{links}<nav>{pagination}</nav></body></html>"
+
+    def worksheet_page(self, slug):
+        n = int(slug.rsplit("-", 1)[1])
+        grade = int("".join(ch for ch in self.grade if ch.isdigit()))
+        grades = "".join(f'<a class="badge playable-tag-banner js-ws-grade-tag" href="/g{g}">GRADE {g}</a>'
+                         for g in ([grade, grade + 1] if n % 3 == 0 else [grade]))
+        topic = TOPICS[n % len(TOPICS)]
+        extra = f'<a class="badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-2" href="/t">{topic} {n % 4}</a>'
+        related = "".join(f'<a href="/s/{SUBJECT}-worksheets/worksheet-{(n + k) % (self.listing_pages * self.per_page)}">related</a>'
+                          for k in (1, 7))
+        return ('<html><body><div class="banner-grades mt-4">' + grades + '</div>'
+                '<div class="banner-subject-topics"><div class="pt-2 text-center"><a href="/math-worksheets">'
+                '<div class="badge playable-tag-banner playable-tag-banner-subject js-ws-subject-tag"> MATH WORKSHEETS </div></a></div>'
+                f'<div class="pt-2 text-center"><a class="badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-1" href="/t">{topic} WORKSHEETS</a></div>'
+                f'<div class="pt-2 text-center">{extra}</div></div>'
+                f'<a href="/worksheet_uploads/pdf/s/{slug}.pdf">Download</a>{related}</body></html>')
+
+    def pdf(self, slug):
+        with self.lock:
+            if slug not in self.pdfs:
+                doc = fitz.open()
+                for p in range(self.pdf_pages):
+                    page = doc.new_page()
+                    page.insert_text((72, 100), f"{slug} page {p + 1}", fontsize=24)
+                    for line in range(20):
+                        page.insert_text((72, 150 + 25 * line), f"{line + 1}. {line * 7} + {line * 3} = ____", fontsize=14)
+                self.pdfs[slug] = doc.tobytes(garbage=3, deflate=True)
+                doc.close()
+            return self.pdfs[slug]
+
+    def respond(self, path):
+        """
+        Return (status, content type, body, kind of page) for a GET of `path`.
+        """
+        parts = path.strip("/").split("/")
+        listing = f"{SUBJECT}-worksheets-for-{self.grade}-graders"
+        if parts[0] == listing:
+            page = int(parts[2]) if len(parts) == 3 and parts[1] == "page" and parts[2].isdigit() else (1 if len(parts) == 1 else 0)
+            if 1 <= page <= self.listing_pages:
+                return 200, "text/html; charset=utf-8", self.listing_page(page).encode(), "listing"
+        elif parts[:2] == ["s", f"{SUBJECT}-worksheets"] and len(parts) == 3:
+            return 200, "text/html; charset=utf-8", self.worksheet_page(parts[2]).encode(), "worksheet"
+        elif parts[:3] == ["worksheet_uploads", "pdf", "s"] and len(parts) == 4 and parts[3].endswith(".pdf"):
+            return 200, "application/pdf", self.pdf(parts[3][:-4]), "pdf"
+        return 404, "text/html", b"<html><body>Not found</body></html>", "missing"
+
+    def start(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self, head=False):
+                if site.latency:
+                    time.sleep(site.latency)
+                status, content_type, body, kind = site.respond(self.path)
+                with site.lock:
+                    site.requests[kind] += 1
+                    failed = site.error_rate and site.random.random() < site.error_rate
+                if failed:
+                    status, content_type, body = 503, "text/html", b"<html><body>Busy</body></html>"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if status == 200 and kind == "pdf":
+                    self.send_header("ETag", '"' + hashlib.md5(body).hexdigest() + '"')
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.handle_error = lambda request, client_address: None  # clients dropping keep-alive connections
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size so far of this process and of its largest (finished) worker process, in MB.
+    ru_maxrss is a high-water mark over the whole run, not over a stage: see timed_stage.
+    """
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KB on Linux
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+
+def timed_stage(results, name, site, function, units):
+    """
+    Run `function()` (which returns the number of `units` it processed) and record its timings in `results`.
+    """
+    site.requests.clear()
+    peak_before = peak_rss_mb()
+    started = time.perf_counter()
+    count = function()
+    seconds = time.perf_counter() - started
+    requests_made = sum(site.requests.values())
+    peak_after = peak_rss_mb()
+    results[name] = {
+        "seconds": round(seconds, 3),
+        units: count,
+        f"{units}_per_second": round(count / seconds, 1) if seconds else None,
+        "requests": requests_made,
+        "requests_per_second": round(requests_made / seconds, 1) if seconds else None,
+        # The run's peak after the stage, and how far the stage raised it (0: it stayed under an earlier stage's peak)
+        "cumulative_peak_rss_mb": peak_after,
+        "peak_rss_growth_mb": {kind: round(peak_after[kind] - peak_before[kind], 1) for kind in peak_after} if peak_after else None,
+    }
+    telemetry.log(pyfilename, f"{name}: {seconds:.2f}s, {count} {units}, {requests_made} requests")
+
+
+def run(args):
+    """
+    Run the pipeline stage by stage against a StandInSite and return the results dict.
+    """
+    site = StandInSite(grade="3rd", listing_pages=args.listing_pages, per_page=args.per_page, pdf_pages=args.pdf_pages,
+                       latency=args.latency, error_rate=args.error_rate, seed=args.seed).start()
+    config = {
+        "splashlearn": {"subject": SUBJECT, "grade": "3rd", "topic": None, "website": site.url,
+                        "worksheet_base": f"{site.url}/s/{SUBJECT}-worksheets",
+                        "pdf_base": f"{site.url}/worksheet_uploads/pdf/s/"},
+        "crawler": {"engine": args.engine, "workers": args.workers, "per_host": args.workers, "requests_per_second": 0,
+                    "checkpoint_every": 50, "mode": "full"},
+    }
+    splashLearn.html_backend = args.parser
+    splashLearn.http_cache = None
+    splashLearn.http_layer = request_layer.RequestLayer(max_concurrency=args.workers, initial_concurrency=args.workers,
+                                                        requests_per_second=0, backoff_base=0.05, backoff_max=1,
+                                                        failure_queue="failed_requests.jsonl")
+    catalog = catalog_module.Catalog("benchmark.db")
+    start_url = f"{site.url}/{SUBJECT}-worksheets-for-3rd-graders"
+    results = {}
+    state = {}
+
+    def l1_crawl():
+        # The links parsed while probing are handed to the L2 crawl, as in a full run
+        state["shared_pages"] = {}
+        state["listing"] = splashLearn.discover_listing_pages(start_url, config["splashlearn"]["worksheet_base"], args.workers,
+                                                              shared_pages=state["shared_pages"])
+        catalog.add_pages(state["listing"], 1, "3rd", SUBJECT)
+        return len(state["listing"])
+
+    def l2_extraction():
+        splashLearn.collect_worksheets(catalog, config, "3rd", SUBJECT, ["3"], test_crawl=False, shared_pages=state["shared_pages"])
+        return catalog.worksheet_count()
+
+    def download():
+        os.makedirs("downloaded_pdfs", exist_ok=True)
+        state["store"] = pdf_store.PdfStore("pdf_store")
+        state["rows"] = pdf_maker.catalog_worksheet_rows(catalog, "GRADE 3", SUBJECT)
+        downloaded = pdf_maker.download_pdfs([(pdf_link, pdf_path) for pdf_link, pdf_path, _, _ in state["rows"]],
+                                             workers=args.workers, layer=splashLearn.http_layer, store=state["store"])
+        state["downloaded"] = downloaded
+        return sum(1 for ok in downloaded.values() if ok)
+
+    def stamping():
+        state["prepared"] = pdf_maker.preprocess_pdfs([(pdf_path, topics, grades) for _, pdf_path, topics, grades in state["rows"]
+                                                       if state["downloaded"].get(pdf_path)], workers=args.processes)
+        return len(state["prepared"])
+
+    def merge():
+        hierarchy, page_counts = pdf_maker.hierarchy_from_rows(state["rows"], state["prepared"])
+        pdf_maker.create_consolidated_pdf(hierarchy, "benchmark_book.pdf", page_counts)
+        with fitz.open("benchmark_book.pdf") as book:
+            return book.page_count
+
+    try:
+        timed_stage(results, "l1_crawl", site, l1_crawl, "pages")
+        timed_stage(results, "l2_extraction", site, l2_extraction, "pages")
+        timed_stage(results, "download", site, download, "pdfs")
+        results["download"]["bytes"] = sum(os.path.getsize(path) for path, ok in state["downloaded"].items() if ok)
+        timed_stage(results, "stamping", site, stamping, "pdfs")
+        timed_stage(results, "merge", site, merge, "pages")
+        results["merge"]["output_bytes"] = os.path.getsize("benchmark_book.pdf")
+    finally:
+        catalog.close()
+        site.stop()
+    return results
+
+
+def compare(results, baseline_path):
+    """
+    Print the change in seconds of every stage against an earlier results file.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["stages"]
+    for stage, result in results.items():
+        before = (baseline.get(stage) or {}).get("seconds")
+        if before:
+            change = 100.0 * (result["seconds"] - before) / before
+            print(f"    {stage:14} {before:8.3f}s -> {result['seconds']:8.3f}s  ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the crawl, download and book-building stages "
+                                                 "against a local SplashLearn stand-in server.")
+    parser.add_argument("--listing-pages", type=int, default=5, help="listing pages on the stand-in site")
+    parser.add_argument("--per-page", type=int, default=20, help="worksheets per listing page")
+    parser.add_argument("--pdf-pages", type=int, default=2, help="pages per worksheet PDF")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses that are 503s")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--engine", choices=["sync", "async"], default="async")
+    parser.add_argument("--parser", choices=["bs4", "fast"], default="fast")
+    parser.add_argument("--workers", type=int, default=16, help="crawler and download threads")
+    parser.add_argument("--processes", type=int, default=0, help="stamping processes. 0 uses one per CPU")
+    parser.add_argument("--workdir", help="directory for the run's files (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="earlier results file to compare stage timings against")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="splashlearn_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        stages = run(args)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "run_at": datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S"),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "workdir")},
+        "stages": stages,
+        "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 3),
+        "metrics": telemetry.metrics.summary(),
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    telemetry.log(pyfilename, f"Results written to {output}")
+    if baseline:
+        compare(stages, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,544 @@
+import os
+import csv
+import json
+import time
+import socket
+import sqlite3
+import threading
+import telemetry
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    level INTEGER NOT NULL,           -- 1: listing pages, 2: worksheet pages
+    grade TEXT,
+    subject TEXT,
+    page_number INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending'  -- pending, done or failed
+);
+CREATE INDEX IF NOT EXISTS pages_by_crawl ON pages (level, grade, subject, page_number);
+
+CREATE TABLE IF NOT EXISTS worksheets (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    grades TEXT NOT NULL,             -- JSON list, e.g. ["GRADE 3", "GRADE 4"]
+    subjects TEXT NOT NULL,           -- JSON list
+    topics TEXT NOT NULL              -- JSON list, main topic first
+);
+
+CREATE TABLE IF NOT EXISTS grades (
+    worksheet_id INTEGER NOT NULL REFERENCES worksheets (id),
+    grade TEXT NOT NULL,
+    UNIQUE (worksheet_id, grade)
+);
+CREATE INDEX IF NOT EXISTS grades_by_grade ON grades (grade);
+
+CREATE TABLE IF NOT EXISTS topics (
+    worksheet_id INTEGER NOT NULL REFERENCES worksheets (id),
+    position INTEGER NOT NULL,        -- 0 is the main topic
+    topic TEXT NOT NULL,
+    UNIQUE (worksheet_id, position)
+);
+CREATE INDEX IF NOT EXISTS topics_by_topic ON topics (topic);
+CREATE INDEX IF NOT EXISTS topics_by_name ON topics (topic COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS subjects (
+    worksheet_id INTEGER NOT NULL REFERENCES worksheets (id),
+    subject TEXT NOT NULL,
+    UNIQUE (worksheet_id, subject)
+);
+CREATE INDEX IF NOT EXISTS subjects_by_name ON subjects (subject COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS pdfs (
+    link TEXT PRIMARY KEY,            -- a PDF is filed under the first worksheet that links to it
+    worksheet_id INTEGER NOT NULL REFERENCES worksheets (id),
+    sha256 TEXT,                      -- content hash in the PDF store, once downloaded
+    pages INTEGER                     -- page count, once stamped
+);
+CREATE INDEX IF NOT EXISTS pdfs_by_worksheet ON pdfs (worksheet_id);
+
+CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+    crawl TEXT NOT NULL,              -- the crawl's start URL (prefixed with its level)
+    url TEXT NOT NULL,
+    visited INTEGER NOT NULL,         -- 1 if the link was found by the crawl
+    depth INTEGER,                    -- set while the page is still waiting to be fetched
+    PRIMARY KEY (crawl, url)
+);
+
+CREATE TABLE IF NOT EXISTS work_items (
+    queue TEXT NOT NULL,              -- e.g. "L2 3rd math" or "PDF downloads"
+    key TEXT NOT NULL,
+    payload TEXT,                     -- JSON
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending, leased, done or failed
+    owner TEXT,                       -- host:pid of the worker holding the lease
+    lease_until REAL,                 -- the lease is up for grabs after this time unless renewed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (queue, key)
+);
+CREATE INDEX IF NOT EXISTS work_items_by_status ON work_items (queue, status);
+"""
+
+
+def flatten(items):
+    """
+    Flatten one level of nesting: ["A", ["B", "C"]] -> ["A", "B", "C"]
+    """
+    return [str(item) for sub in items for item in (sub if isinstance(sub, list) else [sub])]
+
+
+def tagged_with(table, column, values):
+    """
+    Subquery and parameters selecting the worksheets with any of `values` in the subjects or topics index.
+    Labels are matched without regard to case, and the " Worksheets" the site adds to them is optional:
+    "fractions" finds "FRACTIONS WORKSHEETS".
+    """
+    values = [form for value in values for form in (value, f"{value} worksheets")]
+    return f"(SELECT worksheet_id FROM {table} WHERE {column} COLLATE NOCASE IN ({', '.join('?' * len(values))}))", values
+
+
+class Catalog:
+    """
+    SQLite catalog of listing pages, worksheets, their grades and topics, and their PDFs.
+    Replaces the <grade>_grade_<subject>_webpages.txt and _pdf_metadata.csv intermediate files:
+    unique constraints keep every page, worksheet and PDF once, and writes are batched in transactions.
+    """
+
+    def __init__(self, path="splashlearn.db", journal_mode="WAL"):
+        self.path = path
+        self.lock = threading.Lock()
+        # Workers sharing the catalog (see WorkQueue) wait for each other's write transactions
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Catalogs created before pages had a status
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pages)")]
+        if columns and "status" not in columns:
+            self.db.execute("ALTER TABLE pages ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+        # Catalogs created before PDF page counts were kept
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pdfs)")]
+        if columns and "pages" not in columns:
+            self.db.execute("ALTER TABLE pdfs ADD COLUMN pages INTEGER")
+        self.db.executescript(SCHEMA)
+        # Catalogs created before subjects were indexed
+        if not self.db.execute("SELECT 1 FROM subjects LIMIT 1").fetchone():
+            with self.db:
+                self.db.executemany("INSERT OR IGNORE INTO subjects (worksheet_id, subject) VALUES (?, ?)",
+                                    [(worksheet_id, subject) for worksheet_id, subjects in self.db.execute("SELECT id, subjects FROM worksheets")
+                                     for subject in json.loads(subjects)])
+
+    def close(self):
+        self.db.close()
+
+    # Listing pages
+
+    def add_pages(self, urls, level, grade, subject):
+        rows = []
+        for url in urls:
+            page_number = int(url.split("page/")[1]) if "page/" in url else 1
+            rows.append((url, level, grade, subject, page_number))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO pages (url, level, grade, subject, page_number) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def pages(self, level, grade, subject):
+        with self.lock:
+            cursor = self.db.execute("SELECT url FROM pages WHERE level = ? AND grade = ? AND subject = ? ORDER BY page_number, url",
+                                     (level, grade, subject))
+            return [row[0] for row in cursor]
+
+    def pending_pages(self, level, grade, subject):
+        """
+        Pages not yet marked done (never processed, interrupted or failed), in page order.
+        """
+        with self.lock:
+            cursor = self.db.execute("SELECT url FROM pages WHERE level = ? AND grade = ? AND subject = ? AND status != 'done' "
+                                     "ORDER BY page_number, url", (level, grade, subject))
+            return [row[0] for row in cursor]
+
+    def done_pages(self, level, grade, subject):
+        with self.lock:
+            cursor = self.db.execute("SELECT url FROM pages WHERE level = ? AND grade = ? AND subject = ? AND status = 'done'",
+                                     (level, grade, subject))
+            return {row[0] for row in cursor}
+
+    def set_status(self, statuses, level, grade, subject):
+        """
+        Record the status of pages, adding the ones not catalogued yet: `statuses` maps url -> status.
+        """
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO pages (url, level, grade, subject, status) VALUES (?, ?, ?, ?, ?) "
+                                "ON CONFLICT (url) DO UPDATE SET status = excluded.status",
+                                [(url, level, grade, subject, status) for url, status in statuses.items()])
+
+    # Worksheets
+
+    def add_worksheets(self, records):
+        """
+        Insert a batch of (worksheet_url, record) pairs in one transaction, where record is the dict
+        produced by splashLearn.parse_worksheet ({"grades", "subjects", "topics", "pdf_links"}).
+        Worksheets and PDF links that are already catalogued are left as they are.
+        Returns the number of new worksheets.
+        """
+        added = 0
+        with self.lock, self.db:
+            for url, record in records:
+                grades = flatten(record.get("grades", []))
+                subjects = flatten(record.get("subjects", []))
+                topics = flatten(record.get("topics", []))
+                cursor = self.db.execute("INSERT OR IGNORE INTO worksheets (url, grades, subjects, topics) VALUES (?, ?, ?, ?)",
+                                         (url, json.dumps(grades), json.dumps(subjects), json.dumps(topics)))
+                if not cursor.rowcount:
+                    continue
+                added += 1
+                worksheet_id = cursor.lastrowid
+                self.db.executemany("INSERT OR IGNORE INTO grades (worksheet_id, grade) VALUES (?, ?)",
+                                    [(worksheet_id, grade) for grade in grades])
+                self.db.executemany("INSERT OR IGNORE INTO subjects (worksheet_id, subject) VALUES (?, ?)",
+                                    [(worksheet_id, subject) for subject in subjects])
+                self.db.executemany("INSERT OR IGNORE INTO topics (worksheet_id, position, topic) VALUES (?, ?, ?)",
+                                    [(worksheet_id, position, topic) for position, topic in enumerate(topics)])
+                self.db.executemany("INSERT OR IGNORE INTO pdfs (link, worksheet_id) VALUES (?, ?)",
+                                    [(link, worksheet_id) for link in record.get("pdf_links", [])])
+        return added
+
+    def worksheet_count(self, grade_label=None, subject=None):
+        """
+        Number of worksheets, of those tagged `grade_label` and/or `subject` when given.
+        """
+        query = "SELECT COUNT(*) FROM worksheets WHERE 1"
+        parameters = []
+        if grade_label is not None:
+            query += " AND id IN (SELECT worksheet_id FROM grades WHERE grade = ?)"
+            parameters.append(grade_label)
+        if subject is not None:
+            subquery, values = tagged_with("subjects", "subject", [subject])
+            query += " AND id IN " + subquery
+            parameters.extend(values)
+        with self.lock:
+            return self.db.execute(query, parameters).fetchone()[0]
+
+    def worksheet_urls(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT url FROM worksheets")}
+
+    def pdf_rows(self, grade_label, subject=None):
+        """
+        Everything pdf_maker needs to build a book, in one query:
+        [(pdf_link, topics_list, grades_list), ...] for every PDF of a worksheet tagged `grade_label`
+        (and `subject`, when given), in the order the PDFs were catalogued.
+        """
+        return [(link, topics, grades) for link, topics, grades, _ in
+                self.find_pdfs(grade_label, subjects=[subject] if subject else None)]
+
+    def find_pdfs(self, grade_label, subjects=None, topics=None):
+        """
+        Look PDFs up through the grade, subject and topic indexes:
+        [(pdf_link, topics_list, grades_list, pages), ...] for every PDF of a worksheet tagged `grade_label`,
+        any of `subjects` (if given) and any of `topics` (if given, as main topic or subtopic), in the order
+        the PDFs were catalogued. Subjects and topics are matched as in tagged_with.
+        `pages` is None for PDFs that were never stamped.
+        """
+        query = """
+            SELECT p.link, w.topics, w.grades, p.pages
+            FROM pdfs p
+            JOIN worksheets w ON w.id = p.worksheet_id
+            JOIN grades g ON g.worksheet_id = w.id AND g.grade = ?"""
+        parameters = [grade_label]
+        conditions = []
+        for table, column, values in (("subjects", "subject", subjects), ("topics", "topic", topics)):
+            if values:
+                subquery, values = tagged_with(table, column, values)
+                conditions.append("w.id IN " + subquery)
+                parameters.extend(values)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            cursor = self.db.execute(query + " ORDER BY p.rowid", parameters)
+            return [(link, json.loads(topics), json.loads(grades), pages) for link, topics, grades, pages in cursor]
+
+    def set_pdf_hashes(self, hashes):
+        """
+        Record the PDF store digest of downloaded PDFs: `hashes` maps link -> sha256.
+        """
+        with self.lock, self.db:
+            self.db.executemany("UPDATE pdfs SET sha256 = ? WHERE link = ?", [(sha, link) for link, sha in hashes.items()])
+
+    def set_pdf_pages(self, pages):
+        """
+        Record the page count of stamped PDFs: `pages` maps link -> page count.
+        """
+        with self.lock, self.db:
+            self.db.executemany("UPDATE pdfs SET pages = ? WHERE link = ?", [(count, link) for link, count in pages.items()])
+
+    # Migration from the text/CSV intermediate files
+
+    def import_webpages(self, txt_path, grade, subject):
+        with open(txt_path, "r") as f:
+            self.add_pages([line.strip() for line in f if line.strip()], 1, grade, subject)
+
+    def import_csv(self, csv_path):
+        """
+        Import a headerless _pdf_metadata.csv (grades, subjects, topics, pdf_links as comma-joined strings).
+        The CSV does not record worksheet URLs, so each row is keyed by its PDF link.
+        """
+        records = []
+        with open(csv_path, "r", encoding="utf-8-sig") as f:
+            for row in csv.reader(f):
+                if len(row) < 4:
+                    continue
+                split = lambda value: [item.strip() for item in value.split(",") if item.strip()]
+                records.append((f"csv:{row[3].strip()}", {"grades": split(row[0]), "subjects": split(row[1]),
+                                                          "topics": split(row[2]), "pdf_links": split(row[3])}))
+        added = self.add_worksheets(records)
+        telemetry.log(pyfilename, f"Imported {added} worksheets from {csv_path}")
+
+
+class CrawlCheckpoint:
+    """
+    Periodic snapshot of one crawl, kept in the catalog so an interrupted crawl resumes where it stopped.
+    The crawl engines call tick() after every fetched page; every `every` pages the links found so far
+    and the frontier of pages still to fetch (with their depth) are written in one transaction.
+    A snapshot with an empty frontier is a finished crawl: resuming it returns its links without fetching.
+    """
+
+    def __init__(self, catalog, crawl, every=50):
+        self.catalog = catalog
+        self.crawl = crawl
+        self.every = max(1, int(every))
+        self.fetched = 0
+
+    def load(self):
+        """
+        Return (visited, frontier) from the last snapshot, or None if this crawl has none.
+        """
+        with self.catalog.lock:
+            rows = self.catalog.db.execute("SELECT url, visited, depth FROM crawl_checkpoints WHERE crawl = ? ORDER BY rowid",
+                                           (self.crawl,)).fetchall()
+        if not rows:
+            return None
+        visited = {url for url, seen, _ in rows if seen}
+        frontier = [(url, depth) for url, _, depth in rows if depth is not None]
+        telemetry.log(pyfilename, f"Resuming crawl of {self.crawl}: {len(visited)} links found, {len(frontier)} pages left")
+        return visited, frontier
+
+    def tick(self, visited, frontier):
+        self.fetched += 1
+        if self.fetched % self.every == 0:
+            self.save(visited, frontier)
+
+    def save(self, visited, frontier):
+        # Frontier first, so that it is read back in the order it will be fetched
+        rows = {url: [int(url in visited), depth] for url, depth in frontier}
+        for url in visited:
+            rows.setdefault(url, [1, None])
+        with self.catalog.lock, self.catalog.db:
+            self.catalog.db.execute("DELETE FROM crawl_checkpoints WHERE crawl = ?", (self.crawl,))
+            self.catalog.db.executemany("INSERT INTO crawl_checkpoints (crawl, url, visited, depth) VALUES (?, ?, ?, ?)",
+                                        [(self.crawl, url, seen, depth) for url, (seen, depth) in rows.items()])
+
+    def clear(self):
+        with self.catalog.lock, self.catalog.db:
+            self.catalog.db.execute("DELETE FROM crawl_checkpoints WHERE crawl = ?", (self.crawl,))
+
+
+class WorkQueue:
+    """
+    Lease-based work queue kept in the catalog, so any number of worker processes (on this host, or on
+    other hosts sharing the catalog file) can split a stage between them:
+      - add() queues the items not in the queue yet. Items a worker already finished stay finished, so a
+        worker joining late does not hand out work again
+      - reset() starts a new run: once the previous run is over, its done and failed items (or only those
+        the new run needs) are queued again
+      - claim() takes a batch of pending items and leases them to this worker for `lease` seconds.
+        A background thread renews the leases this worker holds, so a lease only runs out when its
+        holder died or lost the catalog. Expired leases are handed to the next worker that claims,
+        and after `max_attempts` claims the item is failed instead
+      - complete() / fail() record the outcome; release() gives back what was not finished
+    batches() and items() claim until the queue is empty, waiting for items other workers still hold
+    so that the stage is complete when they return.
+    """
+
+    def __init__(self, catalog, name, batch=10, lease=300, max_attempts=3, poll=2.0):
+        self.catalog = catalog
+        self.name = name
+        self.batch = max(1, int(batch))
+        self.lease = float(lease)
+        self.max_attempts = max(1, int(max_attempts))
+        self.poll = poll
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.held = set()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def add(self, items):
+        """
+        Queue `items`, a dict of key -> JSON-serialisable payload or an iterable of keys.
+        Items already in the queue are left as they are, whatever their status.
+        """
+        if not isinstance(items, dict):
+            items = dict.fromkeys(items)
+        with self.catalog.lock, self.catalog.db:
+            self.catalog.db.executemany("INSERT INTO work_items (queue, key, payload) VALUES (?, ?, ?) "
+                                        "ON CONFLICT (queue, key) DO NOTHING",
+                                        [(self.name, key, json.dumps(payload)) for key, payload in items.items()])
+
+    def reset(self, keys=None):
+        """
+        Queue the done and failed items of the previous run again: all of them, or only those in `keys`.
+        Does nothing while a run is in progress (items still pending or leased), so workers starting the stage
+        one after another do not undo each other's work. Returns the number of items queued again.
+        """
+        db = self.catalog.db
+        with self.catalog.lock:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                running = db.execute("SELECT COUNT(*) FROM work_items WHERE queue = ? AND status IN ('pending', 'leased')",
+                                     (self.name,)).fetchone()[0]
+                queued = 0
+                if not running:
+                    update = ("UPDATE work_items SET status = 'pending', owner = NULL, lease_until = NULL, attempts = 0, error = NULL "
+                              "WHERE queue = ? AND status IN ('done', 'failed')")
+                    if keys is None:
+                        queued = db.execute(update, (self.name,)).rowcount
+                    else:
+                        queued = db.executemany(update + " AND key = ?", [(self.name, key) for key in keys]).rowcount
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+        if queued:
+            telemetry.log(pyfilename, f"{self.name}: new run, queued {queued} items of the previous run again",
+                          event="queue_reset", queue=self.name, items=queued)
+        return queued
+
+    def claim(self):
+        """
+        Lease up to `batch` pending items to this worker. Returns [(key, payload), ...] in the order they were queued.
+        """
+        now = time.time()
+        db = self.catalog.db
+        with self.catalog.lock:
+            # Take the write lock up front, so two workers never claim the same items
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                expired = db.execute("UPDATE work_items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                     "owner = NULL, error = 'lease expired' "
+                                     "WHERE queue = ? AND status = 'leased' AND lease_until < ?",
+                                     (self.max_attempts, self.name, now)).rowcount
+                rows = db.execute("SELECT key, payload FROM work_items WHERE queue = ? AND status = 'pending' ORDER BY rowid LIMIT ?",
+                                  (self.name, self.batch)).fetchall()
+                db.executemany("UPDATE work_items SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                               "WHERE queue = ? AND key = ?",
+                               [(self.owner, now + self.lease, self.name, key) for key, _ in rows])
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+        if expired:
+            telemetry.metrics.count("queue_leases_expired", expired)
+            telemetry.log(pyfilename, f"{self.name}: took back {expired} items whose worker stopped renewing its lease",
+                          event="queue_expired", queue=self.name, items=expired)
+        self.held.update(key for key, _ in rows)
+        telemetry.metrics.count("queue_items_claimed", len(rows))
+        if rows and self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.keep_alive, daemon=True)
+            self.heartbeat.start()
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def keep_alive(self):
+        while not self.stopped.wait(self.lease / 3):
+            self.renew()
+
+    def renew(self):
+        """
+        Extend the leases this worker holds. Returns the keys it still holds.
+        """
+        keys = list(self.held)
+        if not keys:
+            return keys
+        with self.catalog.lock, self.catalog.db:
+            self.catalog.db.executemany("UPDATE work_items SET lease_until = ? WHERE queue = ? AND key = ? AND owner = ? AND status = 'leased'",
+                                        [(time.time() + self.lease, self.name, key, self.owner) for key in keys])
+        return keys
+
+    def finish(self, keys, status, error=None):
+        keys = list(keys)
+        with self.catalog.lock, self.catalog.db:
+            self.catalog.db.executemany("UPDATE work_items SET status = ?, owner = NULL, lease_until = NULL, error = ? "
+                                        "WHERE queue = ? AND key = ? AND owner = ?",
+                                        [(status, error, self.name, key, self.owner) for key in keys])
+        self.held.difference_update(keys)
+        if status != "pending":
+            telemetry.metrics.count(f"queue_items_{status}", len(keys))
+
+    def complete(self, keys):
+        self.finish(keys, "done")
+
+    def fail(self, keys, error=None):
+        self.finish(keys, "failed", error)
+
+    def release(self):
+        """
+        Give the items this worker still holds back to the queue.
+        """
+        self.finish(self.held, "pending")
+
+    def counts(self):
+        with self.catalog.lock:
+            return dict(self.catalog.db.execute("SELECT status, COUNT(*) FROM work_items WHERE queue = ? GROUP BY status",
+                                                (self.name,)).fetchall())
+
+    def batches(self):
+        """
+        Claim batch after batch until nothing is left. Items of a batch the caller neither completed nor failed
+        are released before the next claim. When only items leased by other workers remain, wait for them:
+        they are either finished or, once their lease expires, claimed here.
+        """
+        waiting = False
+        try:
+            while True:
+                batch = self.claim()
+                if batch:
+                    waiting = False
+                    yield batch
+                    self.release()
+                    continue
+                leased = self.counts().get("leased", 0)
+                if not leased:
+                    return
+                if not waiting:
+                    telemetry.log(pyfilename, f"{self.name}: waiting for {leased} items leased by other workers")
+                    waiting = True
+                time.sleep(self.poll)
+        finally:
+            self.release()
+
+    def items(self):
+        for batch in self.batches():
+            yield from batch
+
+    def close(self):
+        """
+        Stop renewing leases and give back anything still held.
+        """
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        self.release()
+        counts = self.counts()
+        telemetry.log(pyfilename, f"{self.name}: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())),
+                      event="queue", queue=self.name, **counts)
+
+
+def work_queue(catalog, name, queue_config):
+    """
+    The WorkQueue `name` set up from the queue section of config.yaml, or None when the queue is not enabled.
+    """
+    queue_config = queue_config or {}
+    if not queue_config.get('enabled', 0):
+        return None
+    return WorkQueue(catalog, name, batch=queue_config.get('batch', 10), lease=queue_config.get('lease', 300),
+                     max_attempts=queue_config.get('max_attempts', 3))
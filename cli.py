@@ -0,0 +1,190 @@
+import os
+import argparse
+import telemetry
+import catalog as catalog_module
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+STAGES = {
+    "crawl": "find the listing pages of every target and add them to the catalog",
+    "extract": "crawl the listing pages for worksheet pages and catalog their grades, topics and PDF links",
+    "download": "download and stamp the PDFs of every catalogued worksheet",
+    "build": "build the books from the PDFs already downloaded, without network access",
+    "all": "crawl, extract, then download and build",
+    "book": "build a custom book from the PDFs already stamped: one grade, any of the given subjects and topics, "
+            "within a page budget",
+}
+
+
+def load_config(path, args):
+    """
+    Read config.yaml and apply the worker counts given on the command line.
+    """
+    import yaml
+    with open(path, "r") as file_object:
+        config = yaml.load(file_object, Loader=yaml.SafeLoader)
+    overrides = {"crawler": args.crawl_workers, "download": args.download_workers,
+                 "preprocess": args.processes, "book": args.processes}
+    for section, workers in overrides.items():
+        if workers is not None:
+            config[section] = dict(config.get(section) or {}, workers=workers)
+    return config
+
+
+def config_targets(config):
+    """
+    The (grade, subject) books to build. `targets` in config.yaml lists several; without it the single grade and subject are used.
+    """
+    targets = config['splashlearn'].get('targets') or [{'grade': config['splashlearn']['grade'],  # Grade to crawl
+                                                          'subject': config['splashlearn']['subject']}]  # Subject name is based on URL pattern. Options are math and ela.
+    return [(target['grade'], target['subject']) for target in targets]
+
+
+def grade_number(grade_filter):
+    """
+    splashLearn.grade_number, without loading the crawler: 3rd -> 3
+    """
+    return "".join(ch for ch in grade_filter if ch.isdigit())
+
+
+def target_books(targets):
+    """
+    (grade label, subject, output PDF) of the book of every target.
+    """
+    return [("GRADE " + grade_number(grade_filter), subject, f"{grade_filter}_grade_{subject}_consolidated_PDFs.pdf")
+            for grade_filter, subject in targets]
+
+
+def collect(catalog, config, targets, levels, test_crawl, stage):
+    """
+    The crawl (level 1) and extract (level 2) stages, timed as `stage`. Worksheet pages tagged with
+    several grades are fetched once for all the targets of the run.
+    """
+    import splashLearn
+    grades = sorted({grade_number(grade_filter) for grade_filter, _ in targets})
+    shared_pages = {}
+    for grade_filter, subject in targets:
+        telemetry.log(pyfilename, f"Collecting worksheets for grade {grade_filter} {subject}")
+        with telemetry.metrics.stage(stage):
+            splashLearn.collect_worksheets(catalog, config, grade_filter, subject, grades, test_crawl, shared_pages, levels)
+
+
+def prepare_network(config):
+    """
+    Set up the crawler's request layer and response cache, and replay the requests that failed on an earlier run.
+    """
+    import splashLearn
+    splashLearn.configure(config)
+    splashLearn.replay_failed_requests(config.get('download'))
+    return splashLearn
+
+
+def custom_book(catalog, config, args):
+    """
+    The book stage: look the worksheets up in the catalog's indexes and merge their stamped copies.
+    """
+    import pdf_maker
+    grade_label = "GRADE " + grade_number(args.grade)
+    output_pdf = args.output or f"{args.grade}_grade_custom.pdf"
+    hierarchy, page_counts = pdf_maker.query_book(catalog, grade_label, args.subject, args.topic, args.max_pages)
+    if not hierarchy:
+        telemetry.log(pyfilename, "No stamped worksheets match the query. Run the download stage first")
+        return
+    pdf_maker.build_book(hierarchy, output_pdf, page_counts, config.get('book'), f"{os.path.splitext(output_pdf)[0]}_toc.csv")
+    telemetry.log(pyfilename, "All done. Custom book is in the file", output_pdf)
+
+
+def run(args):
+    config = load_config(args.config, args)
+    # Log through a queue written by a background thread, and dump the run's metrics to a JSON summary at exit
+    log_level = config['default']['loglevel']  # Change to DEBUG for all troubleshooting
+    log_http_debug = config['default']['loghttpdebug']  # Change to TRUE if required to log HTTP headers
+    telemetry.setup(log_level, log_http_debug, log_dir=config['default'].get('logdir', 'logs'), name="splashLearn")
+    telemetry.log(pyfilename, f"Running stage {args.stage}" + (" (test run: L2 crawl limited to the first listing page)" if args.test else ""),
+                  event="run", stage=args.stage, test=args.test)
+
+    targets = config_targets(config)
+    books = target_books(targets)
+    # Pages, worksheets and PDF links are kept in a SQLite catalog rather than text/CSV files
+    catalog_config = config.get('catalog') or {}
+    catalog = catalog_module.Catalog(catalog_config.get('path', 'splashlearn.db'), catalog_config.get('journal_mode', 'WAL'))
+    try:
+        if args.stage == "book":
+            custom_book(catalog, config, args)
+            return
+        crawler = None
+        if args.stage in ("crawl", "extract", "download", "all"):
+            crawler = prepare_network(config)
+        if args.stage in ("crawl", "extract", "all"):
+            levels = {"crawl": (1,), "extract": (2,), "all": (1, 2)}[args.stage]
+            collect(catalog, config, targets, levels, args.test, "extract" if args.stage == "extract" else "crawl")
+            if crawler.http_cache is not None:
+                crawler.http_cache.close()
+        if args.stage in ("crawl", "extract"):
+            return
+
+        import pdf_maker
+        layer = crawler.http_layer if crawler else None
+        if args.stage in ("download", "all"):
+            # A new download run: PDFs finished by the previous run are queued again, once per run
+            download_queue = catalog_module.work_queue(catalog, pdf_maker.DOWNLOAD_QUEUE, config.get('queue'))
+            if download_queue is not None:
+                download_queue.reset()
+        if args.stage == "download":
+            pdf_maker.prepare_books(catalog, books, download_config=config.get('download'), layer=layer,
+                                    preprocess_config=config.get('preprocess'), queue_config=config.get('queue'))
+            return
+
+        # build and all. `build` only uses PDFs that are already downloaded
+        telemetry.log(pyfilename, "Beggining PDF download and consolidation" if args.stage == "all" else "Building books from downloaded PDFs")
+        download = args.stage == "all"
+        if len(books) == 1:
+            grade_label, subject, output_pdf = books[0]
+            pdf_maker.build_pdf(catalog, output_pdf,
+                                download_config=config.get('download'), layer=layer,
+                                preprocess_config=config.get('preprocess'), book_config=config.get('book'),
+                                grade_label=grade_label, download=download, queue_config=config.get('queue'), subject=subject)
+        else:
+            # One download and stamping pass over every book, then the books are merged in parallel
+            pdf_maker.build_pdfs(catalog, books,
+                                 download_config=config.get('download'), layer=layer,
+                                 preprocess_config=config.get('preprocess'), book_config=config.get('book'),
+                                 workers=(config.get('book') or {}).get('workers'), download=download,
+                                 queue_config=config.get('queue'))
+        for _, _, output_pdf in books:
+            telemetry.log(pyfilename, "All done. Consolidated PDFs are in the file", output_pdf)
+    finally:
+        catalog.close()
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Collect SplashLearn worksheets and build them into printable books. "
+                                                 "Each stage picks up from what earlier runs saved in the catalog.")
+    subparsers = parser.add_subparsers(dest="stage", required=True, metavar="stage")
+    stages = {}
+    for stage, help_text in STAGES.items():
+        subparser = stages[stage] = subparsers.add_parser(stage, help=help_text, description=help_text)
+        subparser.add_argument("--config", default="config.yaml", help="configuration file (default: config.yaml)")
+        run_mode = subparser.add_mutually_exclusive_group()
+        run_mode.add_argument("--test", action="store_true", help="test run: the L2 crawl stops after the first listing page")
+        run_mode.add_argument("--full", dest="test", action="store_false", help="full run (default)")
+        subparser.set_defaults(test=False)
+        subparser.add_argument("--crawl-workers", type=int, help="async crawler worker pool size (crawler.workers)")
+        subparser.add_argument("--download-workers", type=int, help="parallel PDF downloads (download.workers)")
+        subparser.add_argument("--processes", type=int, help="processes stamping PDFs and building books or volumes "
+                                                             "(preprocess.workers and book.workers). 0 uses one per CPU")
+    book = stages["book"]
+    book.add_argument("--grade", required=True, help="grade of the worksheets, e.g. 3rd")
+    book.add_argument("--subject", action="append", help="keep worksheets of this subject (repeat for several)")
+    book.add_argument("--topic", action="append", help="keep worksheets with this main topic or subtopic (repeat for several)")
+    book.add_argument("--max-pages", type=int, help="worksheet page budget of the book")
+    book.add_argument("--output", help="output PDF (default: <grade>_grade_custom.pdf)")
+    return parser
+
+
+def main(argv=None):
+    run(parser().parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+from html.parser import HTMLParser
+
+# Class attributes the crawler looks for, matched the way BeautifulSoup matches class_=... (see class_matches)
+GRADE_DIV_CLASS = "banner-grades mt-4"
+GRADE_TAG_CLASS = "badge playable-tag-banner js-ws-grade-tag"
+TOPIC_DIV_CLASS = "banner-subject-topics"
+SUBJECT_TAG_CLASS = "badge playable-tag-banner playable-tag-banner-subject js-ws-subject-tag"
+TOPIC_TAG_CLASS = "badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-1"
+EXTRA_TOPIC_TAG_CLASS = "badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-2"
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+                 "source", "track", "wbr"}
+# Text inside these never counts towards a badge's text, as with BeautifulSoup's get_text()
+NON_TEXT_ELEMENTS = {"script", "style", "template"}
+
+
+def class_matches(classes, wanted):
+    """
+    BeautifulSoup's class_ rule: a single class name matches any of the element's class tokens, in any order
+    and among others; a string of several names matches the whole (whitespace-normalised) class attribute.
+    `classes` is the element's list of class tokens.
+    """
+    return wanted in classes or " ".join(classes) == wanted
+
+
+class WorksheetPageParser(HTMLParser):
+    """
+    Single-pass tokenizer that keeps only what the crawler reads from a page, without building a tree:
+      - hrefs:        href of every <a href=...>, in document order
+      - grades:       grade badge texts inside the first 'banner-grades mt-4' div
+      - subjects:     subject badge texts inside the first 'banner-subject-topics' div
+      - topics:       js-ws-topic-tag-1 texts inside that div
+      - extra_topics: js-ws-topic-tag-2 texts inside that div
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.hrefs = []
+        self.grades = []
+        self.subjects = []
+        self.topics = []
+        self.extra_topics = []
+        self.grade_div_found = False
+        self.topic_div_found = False
+        # Open elements: [tag, region, capture] where capture is (target list, index, text parts) or None
+        self.stack = []
+        self.captures = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "a" and "href" in attrs:
+            self.hrefs.append(attrs["href"] or "")
+
+        classes = (attrs.get("class") or "").split()
+        region = self.stack[-1][1] if self.stack else None
+        if tag == "div" and not self.grade_div_found and class_matches(classes, GRADE_DIV_CLASS):
+            self.grade_div_found = True
+            region = "grades"
+        elif tag == "div" and not self.topic_div_found and class_matches(classes, TOPIC_DIV_CLASS):
+            self.topic_div_found = True
+            region = "topics"
+
+        target = None
+        if region == "grades" and tag == "a" and class_matches(classes, GRADE_TAG_CLASS):
+            target = self.grades
+        elif region == "topics" and tag == "div" and class_matches(classes, SUBJECT_TAG_CLASS):
+            target = self.subjects
+        elif region == "topics" and tag == "a" and class_matches(classes, TOPIC_TAG_CLASS):
+            target = self.topics
+        elif region == "topics" and tag == "a" and class_matches(classes, EXTRA_TOPIC_TAG_CLASS):
+            target = self.extra_topics
+
+        if tag in VOID_ELEMENTS:
+            return
+
+        capture = None
+        if target is not None:
+            # Reserve the slot now so nested badges keep document order
+            target.append("")
+            capture = (target, len(target) - 1, [])
+            self.captures.append(capture)
+        self.stack.append([tag, region, capture])
+
+    def handle_endtag(self, tag):
+        # Like BeautifulSoup, an end tag closes the most recent open element with that name
+        # and everything opened after it. Stray end tags are ignored.
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                for frame in reversed(self.stack[i:]):
+                    self._finish(frame)
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data):
+        if not self.captures:
+            return
+        if self.stack and self.stack[-1][0] in NON_TEXT_ELEMENTS:
+            return
+        for capture in self.captures:
+            capture[2].append(data)
+
+    def _finish(self, frame):
+        capture = frame[2]
+        if capture is not None:
+            target, index, parts = capture
+            target[index] = "".join(parts).strip()
+            self.captures.remove(capture)
+
+    def close(self):
+        super().close()
+        for frame in reversed(self.stack):
+            self._finish(frame)
+        self.stack = []
+
+
+def parse(html):
+    """
+    Tokenize `html` once and return the WorksheetPageParser holding the extracted fields.
+    """
+    parser = WorksheetPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
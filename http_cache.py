@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import telemetry
+from collections import Counter
+import requests
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+
+class CachedResponse:
+    """
+    The parts of a requests.Response that the crawler uses, backed by a cached body.
+    """
+
+    def __init__(self, url, content, encoding, status_code=200, from_cache=False):
+        self.url = url
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.status_code = status_code
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def raise_for_status(self):
+        # Only successful responses are ever stored
+        pass
+
+
+class HttpCache:
+    """
+    Content-addressed on-disk HTTP cache.
+
+    Bodies are stored once per SHA-256 digest under <cache_dir>/objects/, so identical pages
+    fetched from different URLs share a file. <cache_dir>/index.json maps each URL to its digest,
+    ETag, Last-Modified and timestamps.
+
+      - Entries younger than `ttl` seconds are served without touching the network.
+      - Older entries are revalidated with a conditional GET (If-None-Match / If-Modified-Since);
+        a 304 reuses the stored body.
+      - evict() drops entries not used for `max_age` seconds, then least-recently-used entries
+        until the stored bodies fit in `max_bytes`.
+    """
+
+    def __init__(self, cache_dir="http_cache", ttl=3600, max_age=30 * 86400, max_bytes=500 * 1024 * 1024,
+                 session=None, timeout=30):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+        self.unsaved_changes = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self.index = json.load(f)
+            except ValueError:
+                telemetry.log(pyfilename, f"Ignoring unreadable cache index {self.index_path}")
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _read_body(self, entry):
+        try:
+            with open(self._object_path(entry["sha256"]), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_body(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.temp"
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        return digest
+
+    def get(self, url):
+        """
+        Return a CachedResponse for `url`, going to the network only when the entry is stale or missing.
+        Raises requests.RequestException on network or HTTP errors, like requests.get + raise_for_status.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.index.get(url)
+            entry = dict(entry) if entry else None
+
+        body = self._read_body(entry) if entry else None
+        if body is not None and now - entry["stored_at"] < self.ttl:
+            self._touch(url, now, stored=False, stat="hits")
+            return CachedResponse(url, body, entry.get("encoding"), from_cache=True)
+
+        headers = {}
+        if body is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and body is not None:
+            self._touch(url, now, stored=True, stat="revalidated")
+            return CachedResponse(url, body, entry.get("encoding"), from_cache=True)
+
+        response.raise_for_status()
+        digest = self._write_body(response.content)
+        telemetry.metrics.count("cache_misses")
+        telemetry.metrics.count("html_bytes_fetched", len(response.content))
+        with self.lock:
+            self.stats["misses"] += 1
+            self.index[url] = {
+                "sha256": digest,
+                "size": len(response.content),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "encoding": response.encoding,
+                "stored_at": now,
+                "last_used": now,
+            }
+            self.unsaved_changes += 1
+            save_now = self.unsaved_changes >= 50
+        if save_now:
+            self.save()
+        return CachedResponse(url, response.content, response.encoding)
+
+    def _touch(self, url, now, stored, stat):
+        telemetry.metrics.count(f"cache_{stat}")
+        with self.lock:
+            self.stats[stat] += 1
+            entry = self.index.get(url)
+            if entry:
+                entry["last_used"] = now
+                if stored:
+                    entry["stored_at"] = now
+                self.unsaved_changes += 1
+
+    def evict(self):
+        """
+        Remove expired entries, then least-recently-used ones until the cache fits in max_bytes.
+        Bodies no longer referenced by any URL are deleted from disk.
+        """
+        now = time.time()
+        with self.lock:
+            for url in [u for u, e in self.index.items() if now - e["last_used"] > self.max_age]:
+                del self.index[url]
+
+            # Several URLs can share one body, so only count each body once
+            sizes = {e["sha256"]: e["size"] for e in self.index.values()}
+            references = Counter(e["sha256"] for e in self.index.values())
+            total = sum(sizes.values())
+            for url, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                del self.index[url]
+                references[entry["sha256"]] -= 1
+                if not references[entry["sha256"]]:
+                    total -= sizes[entry["sha256"]]
+
+            referenced = {e["sha256"] for e in self.index.values()}
+            self.unsaved_changes += 1
+
+        removed = 0
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                if name not in referenced:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+        return removed
+
+    def save(self):
+        with self.lock:
+            if not self.unsaved_changes:
+                return
+            temp_path = self.index_path + ".temp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.index, f)
+            os.replace(temp_path, self.index_path)
+            self.unsaved_changes = 0
+
+    def close(self):
+        self.evict()
+        self.save()
+        telemetry.log(pyfilename, f"HTTP cache: {self.stats['hits']} hits, {self.stats['revalidated']} revalidated (304), {self.stats['misses']} fetched")
@@ -1,9 +1,11 @@
 import os
 import csv
-import requests
+import json
+import hashlib
+import shutil
 import fitz  # PyMuPDF
 from collections import defaultdict
-import datetime
+import telemetry
 
 pyfilename = os.path.basename(__file__).split(".")[0]
 def check_csv_duplicates(csv_path):
@@ -33,33 +35,152 @@ def check_csv_duplicates(csv_path):
 
     if duplicates:
         for link in duplicates:
-            print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5],"\nWARNING: This PDF link is a duplicate and will be skipped if encountered again:", link)
+            telemetry.log(pyfilename, "\nWARNING: This PDF link is a duplicate and will be skipped if encountered again:", link)
 
     return duplicates
 
-import time
-def download_pdf(url, filepath):
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import pdf_store
+import catalog as catalog_module
+
+# Shared HTTP client (pooled session, adaptive concurrency, retries, failure queue).
+# splashLearn passes its own layer to build_pdf so the crawler and the downloader share one
+http_layer = None
+# Work queue through which workers share out the PDF downloads when the queue section of config.yaml enables it
+DOWNLOAD_QUEUE = "PDF downloads"
+
+
+def get_http_layer():
+    global http_layer
+    if http_layer is None:
+        # The HTTP stack is only loaded by the stages that download
+        import request_layer
+        http_layer = request_layer.RequestLayer()
+    return http_layer
+
+
+def download_pdf(url, filepath, layer=None, chunk_size=64 * 1024, store=None):
     """
     Downloads a PDF from the given URL and saves it to the specified filepath.
+    The body is streamed in chunks to a temporary file that is renamed over `filepath` only once complete,
+    so an interrupted download never leaves a truncated PDF behind.
+    Transient errors are retried by the request layer; downloads that still fail are recorded in its
+    failure queue together with `filepath` so they can be replayed.
+    With a PdfStore, a HEAD request is made first: if the URL (or another URL with the same ETag) is
+    already stored with that ETag, `filepath` is linked to the stored copy and nothing is downloaded.
+    New content is hashed while it streams, added to the store, and `filepath` is linked to it.
     Returns True if successful, False otherwise.
     """
-    
+    import requests
+    layer = layer or get_http_layer()
+    temp_path = filepath + ".part"
     try:
-        
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        with open(filepath, 'wb') as f:
-            f.write(r.content)
-        #sleep for 0.5 second to avoid getting blocked
-        time.sleep(0.5)
-        
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,f"    --> Downloaded to {filepath}")
+        etag = None
+        if store is not None:
+            try:
+                head = layer.head(url, timeout=30)
+                if head.ok:
+                    etag = head.headers.get("ETag")
+            except requests.RequestException:
+                pass
+            entry = store.lookup(url)
+            if entry and (etag is None or entry.get("etag") in (None, etag)):
+                store.link(entry["sha256"], filepath)
+                telemetry.metrics.count("pdfs_linked")
+                telemetry.log(pyfilename, f"    --> Linked stored copy to {filepath}", event="pdf_linked", url=url, path=filepath)
+                return True
+            digest = store.lookup_etag(etag)
+            if digest:
+                store.remember(url, digest, etag)
+                store.link(digest, filepath)
+                telemetry.metrics.count("pdfs_linked")
+                telemetry.log(pyfilename, f"    --> Same content already stored, linked to {filepath}", event="pdf_linked", url=url, path=filepath)
+                return True
+
+        digest = hashlib.sha256()
+        size = 0
+        # The request layer counts the download against its concurrency window until this block closes the response
+        with layer.get(url, timeout=30, stream=True, failure_context={"filepath": filepath}) as r:
+            r.raise_for_status()
+            with open(temp_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            headers = r.headers
+
+        if store is not None:
+            store.add(temp_path, digest.hexdigest(), url, headers.get("ETag"), headers.get("Last-Modified"))
+            store.link(digest.hexdigest(), filepath)
+        else:
+            os.replace(temp_path, filepath)
+
+        telemetry.metrics.count("pdfs_downloaded")
+        telemetry.metrics.count("pdf_bytes_downloaded", size)
+        telemetry.log(pyfilename, f"    --> Downloaded to {filepath}", event="pdf_downloaded", url=url, path=filepath, bytes=size)
         return True
     except Exception as e:
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,f"    Failed to download {url}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        telemetry.metrics.count("pdfs_failed")
+        telemetry.log(pyfilename, f"    Failed to download {url}: {e}", event="pdf_failed", url=url, error=str(e))
         return False
 
-def add_headers_to_pdf(pdf_path, topics, grades):
+
+def download_pdfs(jobs, workers=8, chunk_size=64 * 1024, layer=None, store=None):
+    """
+    Download many PDFs in parallel through the shared request layer.
+    `jobs` is a list of (url, filepath) pairs. Files that already exist are skipped, and each URL is
+    fetched once even when several filepaths (topics) need it.
+    With a PdfStore (see download_pdf) content that is already stored is linked instead of downloaded.
+    The layer's adaptive limiter decides how many of the `workers` threads actually hit the server at once.
+    Returns a dict mapping filepath -> True/False (downloaded or already present / failed).
+    """
+    results = {}
+    pending = defaultdict(list)
+    for url, filepath in jobs:
+        if os.path.exists(filepath):
+            results[filepath] = True
+        elif filepath not in results:
+            results[filepath] = False
+            pending[url].append(filepath)
+
+    if not pending:
+        return results
+
+    workers = max(1, int(workers))
+    layer = layer or get_http_layer()
+    telemetry.log(pyfilename, f"Downloading {len(pending)} PDFs with {workers} workers")
+
+    def fetch(job):
+        url, filepaths = job
+        first = filepaths[0]
+        ok = download_pdf(url, first, layer=layer, chunk_size=chunk_size, store=store)
+        outcome = {first: ok}
+        for filepath in filepaths[1:]:
+            if ok and store is not None:
+                store.link(store.lookup(url)["sha256"], filepath)
+            elif ok:
+                shutil.copyfile(first, filepath)
+            outcome[filepath] = ok
+        return outcome
+
+    with telemetry.metrics.stage("download"), ThreadPoolExecutor(max_workers=workers) as executor:
+        for outcome in executor.map(fetch, pending.items()):
+            results.update(outcome)
+
+    if store is not None:
+        store.save()
+        store.report()
+    return results
+
+
+def add_headers_to_pdf(pdf_path, topics, grades, output_path=None):
+    """
+    Stamps topics (top-left) and grades (top-right) on every page of `pdf_path`.
+    The stamped document is written to `output_path`, or over `pdf_path` itself if no output path is given.
+    Returns the number of pages.
+    """
     doc = fitz.open(pdf_path)
     topics_str = ", ".join(topics)
     grades_str = ", ".join(grades)
@@ -72,43 +193,137 @@ def add_headers_to_pdf(pdf_path, topics, grades):
             fontname=font_name)
 
     # 1) Construct a temporary file name
-    temp_path = pdf_path + ".temp"
+    output_path = output_path or pdf_path
+    temp_path = output_path + ".temp"
 
     # 2) Save to the temp file with deflate / garbage collection if you want
     doc.save(temp_path, deflate=True, garbage=4)
 
     # 3) Close the doc
+    page_count = len(doc)
     doc.close()
 
-    # 4) Rename temp file to original, overwriting it
-    os.replace(temp_path, pdf_path)
+    # 4) Rename temp file to the output, overwriting it
+    os.replace(temp_path, output_path)
+    return page_count
+
+
+STAMPED_FOLDER = "stamped_pdfs"
 
 
-def build_topic_hierarchy(csv_path, duplicate_links):
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_stamp_manifest(stamped_folder=STAMPED_FOLDER):
     """
-    Reads the CSV file (no header) and returns a nested dictionary structure:
-      {
-          main_topic_1: {
-             (subtopic1, subtopic2, ...): [pdf_file_1, pdf_file_2, ...],
-             (...): [...]
-          },
-          main_topic_2: { ... },
-          ...
-      }
-    Only includes rows where Grade 3 is present in the 'grades' column (index 0).
-    'pdf_links' is column index 3.
+    The stamp manifest maps each stamped file name to the pristine download it was made from,
+    that file's SHA-256, the header text stamped on it and its page count:
+      {name: {"source": pdf_path, "sha256": ..., "header": [topics, grades], "pages": n}}
+    """
+    manifest_path = os.path.join(stamped_folder, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_stamp_manifest(manifest, stamped_folder=STAMPED_FOLDER):
+    manifest_path = os.path.join(stamped_folder, "manifest.json")
+    # Keep the entries other workers saved in the meantime
+    for name, entry in load_stamp_manifest(stamped_folder).items():
+        manifest.setdefault(name, entry)
+    temp_path = f"{manifest_path}.{os.getpid()}.temp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, manifest_path)
+
+
+def stamped_pdf_path(pdf_path, stamped_folder=STAMPED_FOLDER):
+    return os.path.join(stamped_folder, os.path.basename(pdf_path))
 
-    For each qualifying row:
-      - Skips the row if the link is in 'duplicate_links'.
-      - Checks if the PDF is already downloaded in 'downloaded_pdfs/'.
-        If it exists, skip that row entirely.
-        Otherwise, download the PDF.
-      - Stamps headers (topics top-left, grades top-right).
+
+def prepare_pdf(pdf_path, topics, grades, entry, stamped_folder=STAMPED_FOLDER):
+    """
+    Preprocess one pristine download: stamp a copy into `stamped_folder` unless `entry` (its manifest entry)
+    shows a copy made from the same bytes with the same header text, and count its pages.
+    The pristine file is never modified, so re-running never stacks header text.
+    Runs in a worker process, so it only takes and returns plain data.
+    Returns (stamped_path, manifest entry), or (None, error message) if the PDF cannot be stamped.
     """
-    pdf_folder = "downloaded_pdfs"
-    os.makedirs(pdf_folder, exist_ok=True)
+    stamped_path = stamped_pdf_path(pdf_path, stamped_folder)
+    try:
+        digest = file_sha256(pdf_path)
+        header = [", ".join(topics), ", ".join(grades)]
+        if (entry and entry["sha256"] == digest and entry["header"] == header and "pages" in entry
+                and os.path.exists(stamped_path)):
+            return stamped_path, entry
+
+        page_count = add_headers_to_pdf(pdf_path, topics, grades, output_path=stamped_path)
+    except Exception as e:
+        return None, str(e)
+    return stamped_path, {"source": pdf_path, "sha256": digest, "header": header, "pages": page_count}
 
-    hierarchy = defaultdict(lambda: defaultdict(list))
+
+def preprocess_pdfs(jobs, workers=None, stamped_folder=STAMPED_FOLDER):
+    """
+    Fan the PyMuPDF work (open, stamp, deflate/garbage save, page count) for every worksheet
+    out over a ProcessPoolExecutor with `workers` processes (default: one per CPU).
+    `jobs` is a list of (pdf_path, topics_list, grades_list).
+    Returns {pdf_path: (stamped_path, page_count)} for every file that could be prepared.
+    """
+    os.makedirs(stamped_folder, exist_ok=True)
+    manifest = load_stamp_manifest(stamped_folder)
+    workers = int(workers) if workers else (os.cpu_count() or 1)
+    results = {}
+
+    def collect(pdf_path, outcome):
+        stamped_path, entry = outcome
+        if stamped_path is None:
+            telemetry.log(pyfilename, f"    Failed to stamp {pdf_path}: {entry}")
+            return
+        manifest[os.path.basename(pdf_path)] = entry
+        results[pdf_path] = (stamped_path, entry["pages"])
+        telemetry.metrics.count("pdfs_prepared")
+
+    telemetry.log(pyfilename, f"Preparing {len(jobs)} PDFs with {workers} processes")
+    with telemetry.metrics.stage("stamping"):
+        if workers == 1:
+            for pdf_path, topics, grades in jobs:
+                collect(pdf_path, prepare_pdf(pdf_path, topics, grades, manifest.get(os.path.basename(pdf_path)), stamped_folder))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(prepare_pdf, pdf_path, topics, grades,
+                                           manifest.get(os.path.basename(pdf_path)), stamped_folder): pdf_path
+                           for pdf_path, topics, grades in jobs}
+                for future in as_completed(futures):
+                    collect(futures[future], future.result())
+
+    save_stamp_manifest(manifest, stamped_folder)
+    return results
+
+
+def worksheet_pdf_path(main_topic, pdf_link, grade_label="GRADE 3"):
+    """
+    Where a worksheet PDF is kept in 'downloaded_pdfs/': the grade and main topic name are added
+    to the beggining of the PDF filename, e.g. GRADE3_<main topic>_<file>.pdf
+    """
+    pdf_filename = f"{grade_label.replace(' ', '')}_{main_topic}_{os.path.basename(pdf_link)}"
+    return os.path.join("downloaded_pdfs", pdf_filename)
+
+
+def read_worksheet_rows(csv_path, duplicate_links, grade_label="GRADE 3"):
+    """
+    Reads the CSV file (no header) and returns one (pdf_link, pdf_path, topics_list, grades_list)
+    tuple per qualifying row, in file order.
+    Only includes rows where 'grade_label' is present in the 'grades' column (index 0).
+    'pdf_links' is column index 3. Rows whose link is in 'duplicate_links' are skipped.
+    """
+    rows = []
 
     with open(csv_path, 'r', encoding='utf-8-sig') as f:
         reader = csv.reader(f)
@@ -126,9 +341,9 @@ def build_topic_hierarchy(csv_path, duplicate_links):
             if pdf_link in duplicate_links:
                 continue
 
-            # We only care about rows containing Grade 3
+            # We only care about rows containing the grade of the book
             grades_list = [g.strip() for g in row_grades.split(',')]
-            if 'GRADE 3' not in grades_list:
+            if grade_label not in grades_list:
                 continue
 
             # Parse topics
@@ -137,47 +352,481 @@ def build_topic_hierarchy(csv_path, duplicate_links):
             if not topics_list:
                 continue  # Skip if no topics found
             # The first topic is the "main topic"
-            main_topic = topics_list[0]
-            # Add the grade and main topic name to the beggining of the PDF filename
-            pdf_filename = f"GRADE3_{main_topic}_{os.path.basename(pdf_link)}"
-            pdf_path = os.path.join(pdf_folder, pdf_filename)
-
-            print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5],f"\nProcessing link (line {line_num}): {pdf_link}")
-
-            # If the file is already downloaded, skip
-            if os.path.exists(pdf_path):
-                print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5],f"    File already exists, skipping download: {pdf_path}")
-                # If you want to RE-stamp each time, call add_headers_to_pdf here:
-                add_headers_to_pdf(pdf_path, topics_list, grades_list)
-            else:
-                # Download if not present
-                success = download_pdf(pdf_link, pdf_path)
-                if not success:
-                    continue  # skip if download failed
-                # Stamp headers after download
-                add_headers_to_pdf(pdf_path, topics_list, grades_list)
-
-           
-            # The first topic is the "main topic"
-            main_topic = topics_list[0]
-            # Any subsequent topics are "subtopics"
-            sub_topics = tuple(topics_list[1:]) if len(topics_list) > 1 else ()
+            pdf_path = worksheet_pdf_path(topics_list[0], pdf_link, grade_label)
+
+            rows.append((pdf_link, pdf_path, topics_list, grades_list))
+
+    return rows
+
+
+def catalog_worksheet_rows(catalog, grade_label="GRADE 3", subject=None):
+    """
+    The catalog counterpart of read_worksheet_rows: one (pdf_link, pdf_path, topics_list, grades_list)
+    tuple per PDF of a worksheet tagged 'grade_label' and, when given, 'subject' (e.g. math), in the order
+    they were catalogued. The catalog already keeps each PDF link once, under the first worksheet that linked to it.
+    """
+    rows = []
+    for pdf_link, topics_list, grades_list in catalog.pdf_rows(grade_label, subject):
+        if not topics_list:
+            continue  # Skip if no topics found
+        rows.append((pdf_link, worksheet_pdf_path(topics_list[0], pdf_link, grade_label), topics_list, grades_list))
+    return rows
+
+
+def build_topic_hierarchy(rows, download_config=None, layer=None, preprocess_config=None, store=None, download=True,
+                          work_queue=None):
+    """
+    Takes worksheet rows (from read_worksheet_rows or catalog_worksheet_rows) and returns
+    (hierarchy, page_counts) where hierarchy is a nested dictionary structure:
+      {
+          main_topic_1: {
+             (subtopic1, subtopic2, ...): [pdf_file_1, pdf_file_2, ...],
+             (...): [...]
+          },
+          main_topic_2: { ... },
+          ...
+      }
+    and page_counts maps each of those PDF files to its number of pages.
+
+    Before the hierarchy is built, every PDF that is not yet in 'downloaded_pdfs/' is fetched
+    by the parallel download stage (download_pdfs), configured by 'download_config'. Distinct PDFs
+    are kept once in the content-addressed PdfStore ('store') and 'downloaded_pdfs/' holds links into it.
+    Rows whose download failed are left out. Downloads stay pristine: the preprocessing stage
+    (preprocess_pdfs, configured by 'preprocess_config') stamps headers (topics top-left,
+    grades top-right) on copies in 'stamped_pdfs/' in parallel processes, and the hierarchy
+    lists those stamped copies. With download=False only the PDFs already downloaded are used.
+    With a catalog.WorkQueue ('work_queue') the downloads are shared with other workers (see drain_download_queue).
+    """
+    download_config = download_config or {}
+    if store is None:
+        store = pdf_store.PdfStore(download_config.get('store', 'pdf_store'))
+
+    return hierarchy_from_rows(rows, prepare_rows(rows, download_config, layer, preprocess_config, store, download, work_queue))
+
+
+def drain_download_queue(work_queue, rows, download_config, layer, preprocess_config, store):
+    """
+    Share the download and stamping of 'rows' with every other worker using the same work queue:
+    each worker claims a batch of PDFs, downloads and stamps them, and marks them done, until none are left.
+    Downloads land in the shared PDF store and stamps in the shared stamp manifest, so when this returns
+    every row that could be prepared is on disk, whichever worker prepared it.
+    """
+    work_queue.add({pdf_path: [pdf_link, pdf_path, topics_list, grades_list]
+                    for pdf_link, pdf_path, topics_list, grades_list in rows})
+    for batch in work_queue.batches():
+        jobs = [payload for _, payload in batch]
+        downloaded = download_pdfs([(pdf_link, pdf_path) for pdf_link, pdf_path, _, _ in jobs],
+                                   workers=download_config.get('workers', 8),
+                                   chunk_size=download_config.get('chunk_kb', 64) * 1024,
+                                   layer=layer,
+                                   store=store)
+        prepared = preprocess_pdfs([(pdf_path, topics_list, grades_list)
+                                    for _, pdf_path, topics_list, grades_list in jobs if downloaded.get(pdf_path)],
+                                   workers=preprocess_config.get('workers'))
+        work_queue.complete([pdf_path for _, pdf_path, _, _ in jobs if pdf_path in prepared])
+        work_queue.fail([pdf_path for _, pdf_path, _, _ in jobs if pdf_path not in prepared], "download or stamping failed")
+    work_queue.close()
+    store.refresh()
+
+
+def prepare_rows(rows, download_config, layer, preprocess_config, store, download=True, work_queue=None):
+    """
+    Download and preprocess the PDFs of 'rows' (see build_topic_hierarchy).
+    Returns {pdf_path: (stamped_path, page_count)} for every row that made it through both stages.
+    """
+    os.makedirs("downloaded_pdfs", exist_ok=True)
+    preprocess_config = preprocess_config or {}
+
+    # Download stage: all missing PDFs in parallel, each distinct PDF stored once in the PDF store
+    if download and work_queue is not None:
+        drain_download_queue(work_queue, rows, download_config, layer, preprocess_config, store)
+        # Everything is downloaded and stamped now. The pass below only collects the page counts
+        downloaded = {pdf_path: os.path.exists(pdf_path) for _, pdf_path, _, _ in rows}
+    elif download:
+        downloaded = download_pdfs([(pdf_link, pdf_path) for pdf_link, pdf_path, _, _ in rows],
+                                   workers=download_config.get('workers', 8),
+                                   chunk_size=download_config.get('chunk_kb', 64) * 1024,
+                                   layer=layer,
+                                   store=store)
+    else:
+        # Offline rebuild: use what earlier runs downloaded
+        downloaded = {pdf_path: os.path.exists(pdf_path) for _, pdf_path, _, _ in rows}
+
+    # Preprocessing stage: stamp and count pages of every downloaded PDF across processes
+    prepared = preprocess_pdfs([(pdf_path, topics_list, grades_list)
+                                for _, pdf_path, topics_list, grades_list in rows if downloaded.get(pdf_path)],
+                               workers=preprocess_config.get('workers'))
+    return prepared
+
+
+def hierarchy_from_rows(rows, prepared):
+    """
+    Group the stamped PDFs of 'rows' into the topic hierarchy, returning (hierarchy, page_counts).
+    'prepared' is the result of prepare_rows; rows missing from it are skipped.
+    """
+    hierarchy = defaultdict(lambda: defaultdict(list))
+    page_counts = {}
+
+    for pdf_link, pdf_path, topics_list, grades_list in rows:
+        if pdf_path not in prepared:
+            continue  # skip if download or stamping failed
+        stamped_path, page_count = prepared[pdf_path]
+        page_counts[stamped_path] = page_count
+
+        # The first topic is the "main topic"
+        main_topic = topics_list[0]
+        # Any subsequent topics are "subtopics"
+        sub_topics = tuple(topics_list[1:]) if len(topics_list) > 1 else ()
+
+        hierarchy[main_topic][sub_topics].append(stamped_path)
+
+    return hierarchy, page_counts
+
+
+def record_prepared(catalog, rows, store, page_counts):
+    """
+    Remember in the catalog which stored PDF each link of 'rows' resolved to and, once stamped,
+    its page count, so that query_book can plan books without opening any PDF.
+    """
+    catalog.set_pdf_hashes({pdf_link: entry["sha256"] for pdf_link, _, _, _ in rows
+                            for entry in [store.lookup(pdf_link)] if entry})
+    catalog.set_pdf_pages({pdf_link: page_counts[stamped_pdf_path(pdf_path)] for pdf_link, pdf_path, _, _ in rows
+                           if stamped_pdf_path(pdf_path) in page_counts})
+
+
+def query_book(catalog, grade_label, subjects=None, topics=None, max_pages=None, stamped_folder=STAMPED_FOLDER):
+    """
+    Plan a custom book from the catalog's indexes, e.g. grade 3, fractions OR geometry, at most 200 pages:
+        query_book(catalog, "GRADE 3", topics=["Fractions", "Geometry"], max_pages=200)
+    Worksheets tagged 'grade_label', any of 'subjects' and any of 'topics' (main topic or subtopic) are
+    taken in catalog order while their pages fit in 'max_pages' (worksheet pages, without cover and TOC).
+    Only the stamped copies made by earlier download or build runs are used, with the page counts
+    recorded in the catalog, so nothing is downloaded, stamped or opened.
+    Returns (hierarchy, page_counts), ready for create_consolidated_pdf or build_book.
+    """
+    rows = []
+    prepared = {}
+    total_pages = 0
+    missing = 0
+    for pdf_link, topics_list, grades_list, pages in catalog.find_pdfs(grade_label, subjects, topics):
+        if not topics_list:
+            continue
+        pdf_path = worksheet_pdf_path(topics_list[0], pdf_link, grade_label)
+        stamped_path = stamped_pdf_path(pdf_path, stamped_folder)
+        if pages is None or not os.path.exists(stamped_path):
+            missing += 1
+            continue
+        if max_pages and total_pages + pages > max_pages:
+            continue
+        total_pages += pages
+        rows.append((pdf_link, pdf_path, topics_list, grades_list))
+        prepared[pdf_path] = (stamped_path, pages)
+
+    telemetry.log(pyfilename, f"Query matched {len(rows)} worksheets ({total_pages} pages)"
+                  + (f". {missing} more are not downloaded and stamped yet" if missing else ""),
+                  event="query", grade=grade_label, subjects=subjects, topics=topics, max_pages=max_pages,
+                  worksheets=len(rows), pages=total_pages, missing=missing)
+    return hierarchy_from_rows(rows, prepared)
+
+
+# Layout of the consolidated book: page 0 is the cover, the next pages hold the Table of Contents
+# (as many as plan_book finds it needs), and merged worksheets start right after them
+BOOK_TITLE = "Son/daughter's 2025 H1 Math Worksheets"
+TOC_PAGE_HEIGHT = 792
+TOC_TOP = 110  # Baseline of the first entry on a TOC page
+TOC_BOTTOM_MARGIN = 40
+TOC_LINE_HEIGHT = 20
+TOC_FONT_SIZE = 12
+TOC_TEXT_LEFT = 72
+TOC_TEXT_RIGHT = 476  # Entries wrap before the stars drawn from x=480
+TOC_LEADER = " ................ "
+# The check boxes and stars were drawn as "□" and "★" in the base-14 fonts, which have neither glyph
+# and have always printed them as large middle dots. The same marks are drawn explicitly
+TOC_MARK = "\u00b7"
+
+# PyMuPDF Font objects, created once per process and shared by text measurement and TextWriters
+fonts = {}
+
+
+def get_font(name):
+    if name not in fonts:
+        fonts[name] = fitz.Font(name)
+    return fonts[name]
+
+
+def build_section_plan(hierarchy, page_counts=None):
+    """
+    Turn the topic hierarchy into the ordered list of book sections, one per main topic (alphabetical),
+    each listing its PDFs by sub-topic (alphabetical) with their SHA-256 and page count:
+      [{"title": main_topic, "pages": n, "files": [{"subtopic": ..., "path": ..., "sha256": ..., "pages": n}, ...]}, ...]
+    """
+    page_counts = page_counts or {}
+    sections = []
+    for main_topic in sorted(hierarchy.keys()):
+        subtopics_dict = hierarchy[main_topic]
+        files = []
+        for subtopic_tuple in sorted(subtopics_dict.keys()):
+            for pdf_file in subtopics_dict[subtopic_tuple]:
+                num_pages = page_counts.get(pdf_file)
+                if not num_pages:
+                    with fitz.open(pdf_file) as sub_doc:
+                        num_pages = len(sub_doc)
+                files.append({"subtopic": ", ".join(subtopic_tuple), "path": pdf_file,
+                              "sha256": file_sha256(pdf_file), "pages": num_pages})
+        sections.append({"title": main_topic, "pages": sum(f["pages"] for f in files), "files": files})
+    return sections
+
+
+def section_toc(section, start):
+    """
+    TOC entries [level, title, page_number] for a section whose first page is at index `start`.
+    """
+    toc_list = [[1, section["title"], start]]
+    page = start
+    last_subtopic = None
+    for pdf in section["files"]:
+        if pdf["subtopic"] and pdf["subtopic"] != last_subtopic:
+            toc_list.append([2, pdf["subtopic"], page])
+        last_subtopic = pdf["subtopic"]
+        page += pdf["pages"]
+    return toc_list
+
+
+def insert_section(final_doc, section, start_at=-1):
+    """
+    Insert every PDF of a section into `final_doc` at page index `start_at` (-1 appends).
+    """
+    position = start_at
+    for pdf in section["files"]:
+        telemetry.log(pyfilename, f"Merging PDF into final document: {pdf['path']}")
+        with fitz.open(pdf["path"]) as sub_doc:
+            final_doc.insert_pdf(sub_doc, from_page=0, to_page=pdf["pages"] - 1, start_at=position)
+        telemetry.metrics.count("pdf_pages_merged", pdf["pages"])
+        if position >= 0:
+            position += pdf["pages"]
+
+
+def stamp_page_number(page, page_num):
+    """
+    Centre the page number at the bottom of the page, measured with the font's real metrics.
+    It is written as the page's last content stream, which restamp_page_number relies on.
+    """
+    font = get_font("helv")
+    page_num_str = str(page_num)
+    writer = fitz.TextWriter(page.rect)
+    writer.append(((page.rect.width - font.text_length(page_num_str, fontsize=12)) / 2, page.rect.height - 25),
+                  page_num_str, font=font, fontsize=12)
+    writer.write_text(page)
+
+
+def restamp_page_number(final_doc, page_index):
+    """
+    Replace the page number of a page that moved. stamp_page_number always adds its own content
+    stream last, so dropping the last stream removes the old number before stamping the new one.
+    """
+    page = final_doc[page_index]
+    contents = page.get_contents()
+    if len(contents) > 1:
+        final_doc.xref_set_key(page.xref, "Contents", "[" + " ".join(f"{xref} 0 R" for xref in contents[:-1]) + "]")
+    stamp_page_number(final_doc[page_index], page_index)
+
+
+def toc_entry_lines(level, title, page_number):
+    """
+    Lay out one TOC entry with real font metrics: returns (x, lines), the title wrapped at word
+    boundaries to fit between its indent and the stars, with the leader and page number ending the last line.
+    """
+    font = get_font("helv")
+    x = TOC_TEXT_LEFT + 20 * (level - 1)
+    width = TOC_TEXT_RIGHT - x
+    tail = f"{TOC_LEADER}{page_number}"
+    lines, line = [], ""
+    for word in title.split():
+        candidate = f"{line} {word}" if line else word
+        if line and font.text_length(candidate, fontsize=TOC_FONT_SIZE) > width:
+            lines.append(line)
+            candidate = word
+        line = candidate
+    if line and font.text_length(line + tail, fontsize=TOC_FONT_SIZE) > width:
+        lines.append(line)
+        line = ""
+    lines.append(f"{line}{tail}" if line else tail.lstrip())
+    return x, lines
+
+
+def plan_toc(toc_list, page_height=TOC_PAGE_HEIGHT):
+    """
+    Lay the TOC entries [level, title, page_number] out on pages: returns one list per TOC page
+    of the (x, y, lines) of its entries. An entry that would cross the bottom margin starts the next page.
+    """
+    pages, entries, y = [], [], TOC_TOP
+    bottom = page_height - TOC_BOTTOM_MARGIN
+    for level, title, page_number in toc_list:
+        x, lines = toc_entry_lines(level, title, page_number)
+        height = TOC_LINE_HEIGHT * len(lines)
+        if entries and y + height > bottom:
+            pages.append(entries)
+            entries, y = [], TOC_TOP
+        entries.append((x, y, lines))
+        y += height
+    pages.append(entries)
+    return pages
+
+
+def plan_book(sections):
+    """
+    Place the sections after the TOC, and the TOC on as many pages as its entries need.
+    The page numbers in the TOC depend on how many pages it takes and can make entries wrap,
+    so the TOC grows until its layout fits. Sets each section's "start" and "toc".
+    Returns (toc_layout, toc_list): the TOC pages from plan_toc and all [level, title, page_number] entries.
+    """
+    toc_pages = 1
+    while True:
+        toc_list = []
+        start = 1 + toc_pages
+        for section in sections:
+            section["start"] = start
+            section["toc"] = section_toc(section, start)
+            toc_list.extend(section["toc"])
+            start += section["pages"]
+        toc_layout = plan_toc(toc_list)
+        if len(toc_layout) <= toc_pages:
+            return toc_layout + [[] for _ in range(toc_pages - len(toc_layout))], toc_list
+        toc_pages = len(toc_layout)
+
+
+def render_toc(final_doc, toc_layout, toc_list, toc_csv="toc.csv"):
+    """
+    Write the TOC laid out by plan_book on pages 1..len(toc_layout), and `toc_list` to `toc_csv`.
+    Each page is drawn in one batch per colour through TextWriters sharing the same Font objects.
+    """
+    # Write TOC to a CSV file
+    with open(toc_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["level", "title", "page_number"])
+        for level, title, page_number in toc_list:
+            writer.writerow([level, title, page_number])
+
+    helv, times = get_font("helv"), get_font("tiro")
+    for toc_page_index, entries in enumerate(toc_layout, start=1):
+        toc_page = final_doc[toc_page_index]
+        boxes = fitz.TextWriter(toc_page.rect, color=(0.7, 0.7, 0.7))
+        stars = fitz.TextWriter(toc_page.rect, color=(0.9, 0.9, 0.9))
+        text = fitz.TextWriter(toc_page.rect)
+        heading = "Table of Contents" if toc_page_index == 1 else "Table of Contents (Continued)"
+        text.append((72, 72), heading, font=helv, fontsize=18)
+        for x, y, lines in entries:
+            # Two check boxes on the left of each entry and three stars at the end of it
+            for box_x in (40, 20):
+                boxes.append((box_x, y + 30), TOC_MARK, font=helv, fontsize=100)
+            for star_x in (500, 520, 480):
+                stars.append((star_x, y + 28), TOC_MARK, font=times, fontsize=100)
+            for k, line in enumerate(lines):
+                text.append((x, y + k * TOC_LINE_HEIGHT), line, font=helv, fontsize=TOC_FONT_SIZE)
+        # The marks go under the text
+        if entries:
+            boxes.write_text(toc_page)
+            stars.write_text(toc_page)
+        text.write_text(toc_page)
+
+
+def resource_sizes(doc):
+    """
+    Bytes of (compressed) stream data in `doc` by resource type:
+    image, font, form (Form XObjects), content (page content streams) and other.
+    """
+    font_files = set()
+    for xref in range(1, doc.xref_length()):
+        if doc.xref_get_key(xref, "Type") == ("name", "/FontDescriptor"):
+            for key in ("FontFile", "FontFile2", "FontFile3"):
+                kind, value = doc.xref_get_key(xref, key)
+                if kind == "xref":
+                    font_files.add(int(value.split()[0]))
+    content_streams = {xref for page in doc for xref in page.get_contents()}
+
+    sizes = defaultdict(int)
+    for xref in range(1, doc.xref_length()):
+        if not doc.xref_is_stream(xref):
+            continue
+        subtype = doc.xref_get_key(xref, "Subtype")[1]
+        if subtype == "/Image":
+            kind = "image"
+        elif subtype == "/Form":
+            kind = "form"
+        elif xref in font_files:
+            kind = "font"
+        elif xref in content_streams:
+            kind = "content"
+        else:
+            kind = "other"
+        sizes[kind] += len(doc.xref_stream_raw(xref) or b"")
+    return sizes
+
+
+def save_deduplicated(final_doc, output_pdf):
+    """
+    Finishing pass for a merged book. Every worksheet brings its own copy of the same logos, fonts
+    and artwork; saving with garbage=4 makes MuPDF compare objects and stream contents across the
+    whole file and keep a single copy of each identical image, font and XObject.
+    Prints bytes per resource type before and after, and the final file size.
+    """
+    before = resource_sizes(final_doc)
+    final_doc.save(output_pdf, deflate=True, garbage=4)
+    with fitz.open(output_pdf) as saved:
+        after = resource_sizes(saved)
+
+    # The header carries the figures as structured data; the table is one status line per row
+    telemetry.log(pyfilename, f"Resource size report for {output_pdf}:", event="resource_sizes", path=output_pdf,
+                  before=before, after=after, file_bytes=os.path.getsize(output_pdf))
+    for kind in ("image", "font", "form", "content", "other"):
+        telemetry.log(pyfilename, f"    {kind:<8} {before[kind] / 1024:>12,.1f} KB -> {after[kind] / 1024:>12,.1f} KB")
+    telemetry.log(pyfilename, f"    {'total':<8} {sum(before.values()) / 1024:>12,.1f} KB -> {sum(after.values()) / 1024:>12,.1f} KB"
+                              f"    (file size {os.path.getsize(output_pdf) / 1024:,.1f} KB)")
+
+
+def book_manifest_path(output_pdf):
+    return output_pdf + ".manifest.json"
+
+
+def load_book_manifest(output_pdf):
+    """
+    The book manifest records how `output_pdf` was assembled:
+      {"toc_pages": n, "title": cover title, "incremental_saves": n,
+       "sections": [{"title": ..., "start": page index, "pages": n, "files": [...], "toc": [[level, title, page], ...]}, ...]}
+    """
+    manifest_path = book_manifest_path(output_pdf)
+    if not os.path.exists(manifest_path) or not os.path.exists(output_pdf):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
 
-            hierarchy[main_topic][sub_topics].append(pdf_path)
-    
-    return hierarchy
 
+def save_book_manifest(output_pdf, sections, toc_pages, incremental_saves=0, title=BOOK_TITLE):
+    manifest = {"toc_pages": toc_pages, "title": title, "incremental_saves": incremental_saves, "sections": sections}
+    manifest_path = book_manifest_path(output_pdf)
+    with open(manifest_path + ".temp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + ".temp", manifest_path)
 
-def create_consolidated_pdf(hierarchy, output_pdf):
+
+def create_consolidated_pdf(hierarchy, output_pdf, page_counts=None, sections=None, title=BOOK_TITLE, toc_csv="toc.csv"):
     """
     Creates a consolidated PDF using the nested dictionary `hierarchy`.
     The final PDF will have:
       - Page 0: A cover page
-      - Page 1: A textual Table of Contents
-      - Pages 2+ : Merged PDFs, sorted by main topic (alphabetical),
+      - Pages 1..n: A textual Table of Contents, on as many pages as it needs (see plan_book)
+      - Following pages : Merged PDFs, sorted by main topic (alphabetical),
                    then by sub-topic (alphabetical).
     Page numbers are added at the bottom of each merged page (excluding cover & TOC).
+    `page_counts` (from the preprocessing stage) maps PDF files to their page counts; files missing
+    from it are counted when they are opened.
+    `sections` (from build_section_plan) can be passed instead of a hierarchy.
+    A book manifest is written next to the output so update_consolidated_pdf can rebuild it incrementally.
     """
+    if sections is None:
+        sections = build_section_plan(hierarchy, page_counts)
+    # The TOC is laid out first: its length decides where the sections start
+    toc_layout, toc_list = plan_book(sections)
 
     # 1) Create a brand-new PDF in memory:
     final_doc = fitz.open()
@@ -186,143 +835,273 @@ def create_consolidated_pdf(hierarchy, output_pdf):
     cover_page = final_doc.new_page(width=612, height=792)
     cover_page.insert_text(
         (72, 72),
-        "Son/daughter's 2025 H1 Math Worksheets",
+        title,
         fontsize=24,
         fontname="helv"
     )
 
-    # 3) Add X blank TOC pages (some blank pages for buffer) and insert "Table of Contents"
-    # moved to later to accomodate for multi page Table of Contents.
-    for _ in range(3):
-        final_doc.new_page(width=612, height=792)
-
+    # 3) Add the blank TOC pages. The "Table of Contents" is drawn on them later
+    for _ in range(len(toc_layout)):
+        final_doc.new_page(width=612, height=TOC_PAGE_HEIGHT)
 
-    # 4) Sort the main topics in alphabetical order
-    main_topics_sorted = sorted(hierarchy.keys())
-    # We maintain a TOC list: [ [level, title, page_number], ... ]
-    toc_list = []
+    # 4) Merge each section (main topics in alphabetical order) at the place plan_book gave it
+    for section in sections:
+        insert_section(final_doc, section)
 
-    # We've already used pages 0 (cover) and 1 (TOC).
-    # So the next insertion starts at page index = 2
-    # For set_toc, we need 1-based page numbers, so page index=2 => page number=3
-    current_page_num = 3 # Space for table of contents and worksheets
-
-    # 5) Merge each set of PDFs, and record their places in the TOC
-    for main_topic in main_topics_sorted:
-         # Level-1 TOC entry
-        toc_list.append([1, main_topic, current_page_num + 1])
-        subtopics_dict = hierarchy[main_topic]
-        sorted_subtopics = sorted(subtopics_dict.keys())
-        
-        for subtopic_tuple in sorted_subtopics:
-            if subtopic_tuple:
-                # e.g. subtopic_tuple = ("Quadratic", "Word Problems")
-                subtopic_title = ", ".join(subtopic_tuple)
-                toc_list.append([2, subtopic_title, current_page_num + 1])
-            # Merge the PDFs for this subtopic
-            pdf_files = subtopics_dict[subtopic_tuple]
-           
-            for pdf_file in pdf_files:
-                print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5],f"Merging PDF into final document: {pdf_file}")
-                with fitz.open(pdf_file) as sub_doc:
-                    num_pages = len(sub_doc)
-                    final_doc.insert_pdf(sub_doc, from_page=0, to_page=num_pages - 1)
-                    current_page_num += num_pages
-
-    # 6) Page numbering (skip cover=0 and TOC and notes =1-100)
+    # 5) Page numbering (skip cover=0 and TOC and notes =1-100)
     total_pages = final_doc.page_count
-    print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5],f"Total pages: {total_pages}")
+    telemetry.log(pyfilename, f"Total pages: {total_pages}")
     for i in range(total_pages):
         if i < 2:
             continue
-        page = final_doc[i]
-        page_num_str = str(i)
+        stamp_page_number(final_doc[i], i)
 
-        # Roughly estimate each character ~6 points wide at 12pt font:
-        approx_char_width = 6
-        text_w = approx_char_width * len(page_num_str)
+    # 6) Build a text-based TOC (index=1)
+    render_toc(final_doc, toc_layout, toc_list, toc_csv)
 
-        x_coord = (page.rect.width - text_w) / 2
-        y_coord = page.rect.height - 25
+    # 7) Also set the PDF's internal TOC (bookmarks)
+    final_doc.set_toc(toc_list)
 
-        page.insert_text(
-            (x_coord, y_coord),
-            page_num_str,
-            fontsize=12,
-            fontname="helv"
-        )
+    # 8) Save with shared resources deduplicated, and close
+    save_deduplicated(final_doc, output_pdf)
+    final_doc.close()
+    save_book_manifest(output_pdf, sections, len(toc_layout), title=title)
 
 
-    # 7) Build a text-based TOC (index=1)
-    toc_page_index = 1
-    toc_page = final_doc[toc_page_index]
+# Full saves compact the file; incremental saves only append changes, so force a full save now and then
+MAX_INCREMENTAL_SAVES = 5
 
-    # Insert the initial TOC heading on page 1:
-    toc_page.insert_text((72, 72), "Table of Contents", fontsize=18, fontname="helv")
 
-    # We'll start listing entries at y=110
-    y_cursor = 110
-    line_height = 20  # vertical spacing per TOC line
-    # Write TOC to a CSV file
-    with open("toc.csv", "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["level", "title", "page_number"])
-        for level, title, page_number in toc_list:
-            writer.writerow([level, title, page_number])
+def update_consolidated_pdf(hierarchy, output_pdf, page_counts=None, sections=None, title=BOOK_TITLE, toc_csv="toc.csv"):
+    """
+    Rebuild `output_pdf` from `hierarchy`, reusing every section whose PDFs are unchanged according
+    to the book manifest. Removed and changed sections are deleted, new and changed sections are
+    inserted from their PDFs, moved pages get their page number re-stamped, the TOC pages and
+    bookmarks are redrawn, and the result is saved incrementally where PyMuPDF allows it.
+    Falls back to create_consolidated_pdf when there is no usable manifest or the cover title changed.
+    """
+    if sections is None:
+        sections = build_section_plan(hierarchy, page_counts)
+    manifest = load_book_manifest(output_pdf)
+    if manifest is None or manifest.get("title", BOOK_TITLE) != title:
+        create_consolidated_pdf(hierarchy, output_pdf, sections=sections, title=title, toc_csv=toc_csv)
+        return
 
-    for level, title, page_number in toc_list:
-        # If we are near the bottom of the page, go to the next TOC page
-        if y_cursor + line_height > toc_page.rect.height - 40:
-            # don't create a brand new page for page but just go to the next page
-            toc_page_index += 1
-
-            toc_page = final_doc[toc_page_index]
-
-            # Optionally label continuation:
-            
-            toc_page.insert_text((72, 72), "Table of Contents (Continued)", fontsize=18, fontname="helv")
-
-            # Reset y-cursor on this new page
-            y_cursor = 110
-
-        indent = 20 * (level - 1)
-        toc_line = f"{title} ................ {page_number}"
-
-        # Write this entry
-        # Add a check box on the left of each toc_line entry. checkbox should be blank and not filled
-   
-        # star character
-        starchar = "★"
-        
-
-        toc_page.insert_text((40, y_cursor+30), "□", fontsize=100, fontname="helv", color=(0.7, 0.7, 0.7))
-        toc_page.insert_text((20, y_cursor+30), "□", fontsize=100, fontname="helv", color=(0.7, 0.7, 0.7))
-        
-        # insert 3 stars at the end of each line
-        toc_page.insert_text((500, y_cursor+28), starchar, fontsize=100, fontname="times-roman", color=(0.9, 0.9, 0.9))
-        toc_page.insert_text((520, y_cursor+28), starchar, fontsize=100, fontname="times-roman", color=(0.9, 0.9, 0.9))
-        toc_page.insert_text((480, y_cursor+28), starchar, fontsize=100, fontname="times-roman", color=(0.9, 0.9, 0.9))
-
-        toc_page.insert_text((72 + indent, y_cursor), toc_line, fontsize=12, fontname="helv")
-        y_cursor += line_height
-
-    # 8) Also set the PDF's internal TOC (bookmarks)
+    def same(a, b):
+        return a["title"] == b["title"] and a["files"] == b["files"]
+
+    new_by_title = {section["title"]: section for section in sections}
+    kept = [old for old in manifest["sections"] if old["title"] in new_by_title and same(old, new_by_title[old["title"]])]
+    kept_titles = {old["title"] for old in kept}
+    if len(kept) == len(manifest["sections"]) == len(sections):
+        telemetry.log(pyfilename, f"No worksheet changes, {output_pdf} is up to date")
+        return
+
+    toc_layout, toc_list = plan_book(sections)
+    final_doc = fitz.open(output_pdf)
+
+    # 1) Delete removed and changed sections, last first so earlier page indexes stay valid
+    for old in sorted(manifest["sections"], key=lambda s: s["start"], reverse=True):
+        if old["title"] not in kept_titles:
+            final_doc.delete_pages(old["start"], old["start"] + old["pages"] - 1)
+
+    # 2) Replace the TOC with as many fresh pages as the new one needs
+    final_doc.delete_pages(1, manifest.get("toc_pages", 3))
+    for i in range(len(toc_layout)):
+        final_doc.new_page(pno=1 + i, width=612, height=TOC_PAGE_HEIGHT)
+    for i in range(2, 1 + len(toc_layout)):
+        stamp_page_number(final_doc[i], i)
+
+    # 3) Walk the new plan. Kept sections are already in place (both plans are sorted by title),
+    #    the rest are inserted where plan_book put them
+    old_start = {old["title"]: old["start"] for old in kept}
+    rebuilt = 0
+    for section in sections:
+        start = section["start"]
+        if section["title"] in kept_titles:
+            if old_start[section["title"]] != start:
+                for i in range(start, start + section["pages"]):
+                    restamp_page_number(final_doc, i)
+        else:
+            insert_section(final_doc, section, start_at=start)
+            for i in range(start, start + section["pages"]):
+                stamp_page_number(final_doc[i], i)
+            rebuilt += 1
+
+    render_toc(final_doc, toc_layout, toc_list, toc_csv)
     final_doc.set_toc(toc_list)
 
-    # 9) Save and close
-    final_doc.save(output_pdf,deflate=True)
+    telemetry.log(pyfilename, f"Rebuilt {rebuilt} of {len(sections)} sections. Total pages: {final_doc.page_count}")
+
+    # 4) Save
+    incremental_saves = manifest.get("incremental_saves", 0)
+    if incremental_saves < MAX_INCREMENTAL_SAVES and final_doc.can_save_incrementally():
+        final_doc.save(output_pdf, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        incremental_saves += 1
+    else:
+        temp_path = output_pdf + ".temp"
+        save_deduplicated(final_doc, temp_path)
+        incremental_saves = 0
     final_doc.close()
+    if not incremental_saves:
+        os.replace(temp_path, output_pdf)
+    save_book_manifest(output_pdf, sections, len(toc_layout), incremental_saves, title)
+
+
+
+def split_volumes(sections, max_pages=None, max_bytes=None):
+    """
+    Group sections into volumes at topic boundaries so each volume stays under `max_pages` pages and
+    `max_bytes` bytes of input PDFs (either budget can be None). A single topic larger than the
+    budget gets a volume of its own.
+    """
+    volumes = []
+    current, pages, size = [], 0, 0
+    for section in sections:
+        section_bytes = sum(os.path.getsize(pdf["path"]) for pdf in section["files"])
+        over_pages = max_pages and pages + section["pages"] > max_pages
+        over_bytes = max_bytes and size + section_bytes > max_bytes
+        if current and (over_pages or over_bytes):
+            volumes.append(current)
+            current, pages, size = [], 0, 0
+        current.append(section)
+        pages += section["pages"]
+        size += section_bytes
+    if current:
+        volumes.append(current)
+    return volumes
+
 
+def build_volume(volume_pdf, sections, title, toc_csv):
+    """
+    Worker: build (or incrementally update) one volume. Runs in its own process, so the memory
+    it needs is bounded by the size of that volume.
+    """
+    update_consolidated_pdf(None, volume_pdf, sections=sections, title=title, toc_csv=toc_csv)
+    return volume_pdf
+
+
+def run_in_processes(function, jobs, workers):
+    """
+    Run function(*job) for every job in a pool of at most `workers` processes and return the results in order.
+    What the workers count (e.g. pages merged) is added to this process's run metrics.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        for result, snapshot in executor.map(telemetry.call_with_metrics, [function] * len(jobs), *zip(*jobs)):
+            telemetry.metrics.merge(snapshot)
+            results.append(result)
+    return results
 
 
-def build_pdf(input_csv, output_pdf):
-    
-    # 1) Identify duplicates (rows with repeated link in col 3).
-    duplicates = check_csv_duplicates(input_csv)
+def create_volumes(hierarchy, output_pdf, page_counts=None, max_pages=None, max_bytes=None, workers=None):
+    """
+    Split the book into volumes at topic boundaries (see split_volumes) and build them in parallel
+    processes. Each volume is a complete book with its own cover, TOC and bookmarks, saved as
+    <output stem>_vol<k>.pdf. Returns the list of volume paths.
+    """
+    sections = build_section_plan(hierarchy, page_counts)
+    volumes = split_volumes(sections, max_pages, max_bytes)
+    stem, ext = os.path.splitext(output_pdf)
+    workers = int(workers) if workers else (os.cpu_count() or 1)
+
+    jobs = []
+    for k, volume_sections in enumerate(volumes, start=1):
+        volume_stem = f"{stem}_vol{k}"
+        title = f"{BOOK_TITLE}\nVolume {k} of {len(volumes)}"
+        jobs.append((f"{volume_stem}{ext}", volume_sections, title, f"{volume_stem}_toc.csv"))
+
+    telemetry.log(pyfilename, f"Building {len(jobs)} volumes with {min(workers, len(jobs))} processes")
+    if workers == 1 or len(jobs) == 1:
+        return [build_volume(*job) for job in jobs]
+    return run_in_processes(build_volume, jobs, workers)
+
+
+def build_pdf(source, output_pdf, download_config=None, layer=None, preprocess_config=None, book_config=None,
+              grade_label="GRADE 3", download=True, queue_config=None, subject=None):
+    """
+    Build the book from 'source': either a catalog.Catalog or the path of a legacy headerless
+    _pdf_metadata.csv, using the worksheets tagged 'grade_label'. From a catalog, only the worksheets
+    of 'subject' are used when it is given.
+    With download=False the book is built from the PDFs already downloaded, without network access.
+    With the work queue enabled in 'queue_config', downloads from a catalog are shared with other workers.
+    """
+    download_config = download_config or {}
+    store = pdf_store.PdfStore(download_config.get('store', 'pdf_store'))
+
+    # 1) Read the worksheet rows. In a CSV, links repeated across rows are identified and skipped.
+    work_queue = None
+    if isinstance(source, str):
+        duplicates = check_csv_duplicates(source)
+        rows = read_worksheet_rows(source, duplicates, grade_label)
+    else:
+        rows = catalog_worksheet_rows(source, grade_label, subject)
+        work_queue = catalog_module.work_queue(source, DOWNLOAD_QUEUE, queue_config)
 
-    # 2) Build hierarchy, skipping duplicates, blank lines, lines <4 cols, etc.
-    topic_hierarchy = build_topic_hierarchy(input_csv, duplicates)
+    # 2) Download and stamp missing PDFs, then build hierarchy
+    topic_hierarchy, page_counts = build_topic_hierarchy(rows, download_config, layer, preprocess_config, store, download,
+                                                         work_queue)
+    if not isinstance(source, str):
+        record_prepared(source, rows, store, page_counts)
+
+    # 3) Merge everything into a final PDF (with cover and TOC)
+    build_book(topic_hierarchy, output_pdf, page_counts, book_config)
+
+
+def build_book(topic_hierarchy, output_pdf, page_counts=None, book_config=None, toc_csv="toc.csv"):
+    """
+    Merge the hierarchy into a final PDF (with cover and TOC), reusing unchanged sections of an earlier build.
+    With a page or size budget in 'book_config' the book is split into volumes built in parallel instead.
+    """
+    book_config = book_config or {}
+    max_pages = book_config.get('max_pages') or None
+    max_bytes = (book_config.get('max_mb') or 0) * 1024 * 1024 or None
+    with telemetry.metrics.stage("merge"):
+        if max_pages or max_bytes:
+            create_volumes(topic_hierarchy, output_pdf, page_counts, max_pages, max_bytes, book_config.get('workers'))
+        else:
+            update_consolidated_pdf(topic_hierarchy, output_pdf, page_counts, toc_csv=toc_csv)
+    return output_pdf
+
+
+def prepare_books(catalog, books, download_config=None, layer=None, preprocess_config=None, download=True,
+                  queue_config=None):
+    """
+    Download and stamp the PDFs of several books in one pass, each distinct file once, and record
+    their PDF store digests in the catalog. 'books' is a list of (grade_label, subject, output_pdf).
+    With the work queue enabled in 'queue_config', the pass is shared with every other worker running it.
+    Returns ([(rows, output_pdf), ...], prepared) for build_pdfs.
+    """
+    download_config = download_config or {}
+    store = pdf_store.PdfStore(download_config.get('store', 'pdf_store'))
+
+    book_rows = [(catalog_worksheet_rows(catalog, grade_label, subject), output_pdf) for grade_label, subject, output_pdf in books]
+    all_rows = list({row[1]: row for rows, _ in book_rows for row in rows}.values())
+    work_queue = catalog_module.work_queue(catalog, DOWNLOAD_QUEUE, queue_config)
+    prepared = prepare_rows(all_rows, download_config, layer, preprocess_config, store, download, work_queue)
+    record_prepared(catalog, all_rows, store, dict(prepared.values()))
+    return book_rows, prepared
+
+
+def build_pdfs(catalog, books, download_config=None, layer=None, preprocess_config=None, book_config=None, workers=None,
+               download=True, queue_config=None):
+    """
+    Build several books from one catalog. 'books' is a list of (grade_label, subject, output_pdf).
+    The PDFs of all books are downloaded into the shared PDF store and stamped in one pass (prepare_books),
+    then the books are merged in parallel processes, each with its own <stem>_toc.csv.
+    """
+    book_rows, prepared = prepare_books(catalog, books, download_config, layer, preprocess_config, download, queue_config)
 
-    # 3) Merge everything into a final PDF (with cover and TOC).
-    create_consolidated_pdf(topic_hierarchy, output_pdf)
+    jobs = []
+    for rows, output_pdf in book_rows:
+        hierarchy, page_counts = hierarchy_from_rows(rows, prepared)
+        # Plain dicts, so the hierarchy can be sent to another process
+        hierarchy = {main_topic: dict(subtopics) for main_topic, subtopics in hierarchy.items()}
+        jobs.append((hierarchy, output_pdf, page_counts, book_config, f"{os.path.splitext(output_pdf)[0]}_toc.csv"))
 
+    workers = int(workers) if workers else (os.cpu_count() or 1)
+    telemetry.log(pyfilename, f"Building {len(jobs)} books with {min(workers, len(jobs))} processes")
+    if workers == 1 or len(jobs) == 1:
+        return [build_book(*job) for job in jobs]
+    with telemetry.metrics.stage("merge"):
+        return run_in_processes(build_book, jobs, workers)
@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import threading
+import telemetry
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+
+class PdfStore:
+    """
+    Content-addressed store for downloaded worksheets.
+
+    Each distinct PDF is kept once as <root>/objects/<sha[:2]>/<sha>.pdf. <root>/index.json maps every
+    URL to the digest of its content plus the ETag / Last-Modified seen when it was fetched, so that
+      - a URL already in the store is not downloaded again while its ETag is unchanged, and
+      - a new URL whose ETag matches stored content is linked to that content without a download.
+    The per-topic files in downloaded_pdfs/ are hard links to (or, where links are not supported,
+    copies of) the stored objects, so a worksheet filed under several topics takes disk space once.
+    """
+
+    def __init__(self, root="pdf_store"):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.index_path = os.path.join(root, "index.json")
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = {}
+        self.by_etag = {}
+        self.refresh()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest + ".pdf")
+
+    def lookup(self, url):
+        """
+        Return the index entry for `url` if its content is in the store, else None.
+        """
+        with self.lock:
+            entry = self.index.get(url)
+        if entry and os.path.exists(self.object_path(entry["sha256"])):
+            return entry
+        return None
+
+    def lookup_etag(self, etag):
+        """
+        Return the digest of stored content that was served with `etag`, else None.
+        """
+        with self.lock:
+            digest = self.by_etag.get(etag) if etag else None
+        if digest and os.path.exists(self.object_path(digest)):
+            return digest
+        return None
+
+    def remember(self, url, digest, etag=None, last_modified=None):
+        with self.lock:
+            self.index[url] = {"sha256": digest, "etag": etag, "last_modified": last_modified}
+            if etag:
+                self.by_etag[etag] = digest
+
+    def add(self, temp_path, digest, url, etag=None, last_modified=None):
+        """
+        Move a completed download (already hashed to `digest`) into the store.
+        If the same content is already stored the download is simply discarded.
+        """
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+        self.remember(url, digest, etag, last_modified)
+        return path
+
+    def link(self, digest, filepath):
+        """
+        Make `filepath` point at the stored object `digest`.
+        """
+        path = self.object_path(digest)
+        temp_path = filepath + ".link"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(path, temp_path)
+        except OSError:
+            shutil.copyfile(path, temp_path)
+        os.replace(temp_path, filepath)
+
+    def refresh(self):
+        """
+        Add the index entries saved since this store was loaded, e.g. by other workers sharing the store.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        with self.lock:
+            for url, entry in saved.items():
+                self.index.setdefault(url, entry)
+            self.by_etag = {e["etag"]: e["sha256"] for e in self.index.values() if e.get("etag")}
+
+    def save(self):
+        # Keep what other workers saved in the meantime
+        self.refresh()
+        with self.lock:
+            temp_path = f"{self.index_path}.{os.getpid()}.temp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(temp_path, self.index_path)
+
+    def report(self):
+        digests = {e["sha256"] for e in self.index.values()}
+        telemetry.log(pyfilename, f"PDF store: {len(self.index)} URLs, {len(digests)} unique PDFs")
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import random
+import threading
+import datetime
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+import telemetry
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+# Responses worth retrying. Everything else (2xx, 3xx, 304, 404, ...) is handed back to the caller
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Network errors worth retrying, including a body cut off mid-transfer. Other request errors
+# (TooManyRedirects, InvalidURL, ...) fail the same way every time and are raised at once
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def make_session(pool_size=16):
+    """
+    Create a requests.Session whose keep-alive connection pool can serve `pool_size` threads at once.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency window shared by every thread using a RequestLayer.
+    The window grows by one after a full window of fast successful responses, and halves
+    (at most once per `cooldown` seconds) on a 429/5xx, a network error or a response slower
+    than `target_latency`. A Retry-After header pauses all new requests until it has passed.
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=16, initial_concurrency=4,
+                 requests_per_second=10, target_latency=2.0, cooldown=5.0):
+        self.min_concurrency = max(1, int(min_concurrency))
+        self.max_concurrency = max(self.min_concurrency, int(max_concurrency))
+        self.limit = min(max(int(initial_concurrency), self.min_concurrency), self.max_concurrency)
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.next_start = 0.0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            start = max(now, self.next_start, self.paused_until)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, ok, latency=None, retry_after=None):
+        """
+        Free a slot. ok=None frees it without counting the request as a success or a failure.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+            if ok is None:
+                return
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            slow = latency is not None and self.target_latency and latency > self.target_latency
+            if not ok or slow:
+                self.successes = 0
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.min_concurrency, self.limit // 2)
+                    self.last_decrease = now
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+
+
+class FailureQueue:
+    """
+    Append-only JSON-lines file of requests that still failed after every retry.
+    Each line holds the method, URL, reason, attempt count, time and any caller context
+    (for example the file a PDF should have been written to), so the request can be replayed later.
+    """
+
+    def __init__(self, path="failed_requests.jsonl"):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, method, url, reason, attempts, context=None):
+        entry = {
+            "method": method,
+            "url": url,
+            "reason": reason,
+            "attempts": attempts,
+            "failed_at": datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S"),
+            "context": context or {},
+        }
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def take(self):
+        """
+        Remove and return every queued entry. Entries that fail again on replay are re-recorded.
+        """
+        with self.lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+            os.remove(self.path)
+        return entries
+
+
+class RequestLayer:
+    """
+    The one HTTP client used by the crawler, the response cache and the PDF downloader.
+      - one pooled keep-alive session
+      - an AdaptiveLimiter deciding how many requests may be in flight
+      - retries of network errors and 429/5xx responses with jittered exponential backoff,
+        honouring Retry-After
+      - requests that exhaust their retries are written to a FailureQueue
+    get() and head() mirror requests.Session.get/head: retryable failures that run out of attempts return the last
+    response (so raise_for_status() still raises) or re-raise the last network error.
+    A streamed response keeps its limiter slot until it is closed, so close it (or use it in a with block)
+    once the body has been read.
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=16, initial_concurrency=4, requests_per_second=10,
+                 target_latency=2.0, max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 failure_queue="failed_requests.jsonl", timeout=30):
+        self.session = make_session(max_concurrency)
+        self.limiter = AdaptiveLimiter(min_concurrency, max_concurrency, initial_concurrency,
+                                       requests_per_second, target_latency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = FailureQueue(failure_queue)
+        self.timeout = timeout
+
+    def _backoff(self, attempt, retry_after):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # "Full jitter": a random delay up to the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def get(self, url, headers=None, stream=False, timeout=None, failure_context=None):
+        return self.request("GET", url, headers=headers, stream=stream, timeout=timeout, failure_context=failure_context)
+
+    def head(self, url, headers=None, timeout=None):
+        return self.request("HEAD", url, headers=headers, timeout=timeout)
+
+    def request(self, method, url, headers=None, stream=False, timeout=None, failure_context=None):
+        """
+        Send one request with retries. Only GETs that run out of retries go to the failure queue;
+        other methods are probes whose callers fall back to a GET.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=headers, stream=stream, timeout=timeout or self.timeout)
+            except RETRY_ERRORS as e:
+                self.limiter.release(ok=False)
+                telemetry.metrics.count("request_errors")
+                if attempt >= self.max_retries:
+                    if method == "GET":
+                        self.failures.record(method, url, str(e), attempt + 1, failure_context)
+                        telemetry.metrics.count("requests_failed")
+                    raise
+                delay = self._backoff(attempt, None)
+                reason = str(e)
+            except BaseException:
+                # Not a sign of load: give the slot back and let the caller see the error
+                self.limiter.release(ok=None)
+                raise
+            else:
+                latency = time.monotonic() - started
+                telemetry.metrics.count("requests")
+                telemetry.metrics.observe("request_seconds", latency)
+                if response.status_code not in RETRY_STATUSES:
+                    if stream:
+                        # The body is still to come: the window covers the transfer, not just the headers
+                        release_on_close(response, self.limiter, latency)
+                    else:
+                        self.limiter.release(ok=True, latency=latency)
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                self.limiter.release(ok=False, latency=latency, retry_after=retry_after)
+                if attempt >= self.max_retries:
+                    if method == "GET":
+                        self.failures.record(method, url, f"HTTP {response.status_code}", attempt + 1, failure_context)
+                        telemetry.metrics.count("requests_failed")
+                    return response
+                response.close()
+                delay = self._backoff(attempt, retry_after)
+                reason = f"HTTP {response.status_code}"
+
+            attempt += 1
+            telemetry.metrics.count("retries")
+            telemetry.log(pyfilename, f"Retry {attempt}/{self.max_retries} for {url} in {delay:.1f}s ({reason})",
+                          event="retry", url=url, attempt=attempt, delay=round(delay, 2), reason=reason)
+            time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+def release_on_close(response, limiter, latency):
+    """
+    Give the limiter slot of a streamed `response` back the first time the response is closed.
+    """
+    close = response.close
+    once = threading.Lock()
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if once.acquire(blocking=False):
+                limiter.release(ok=True, latency=latency)
+
+    response.close = close_and_release
+
+
+def parse_retry_after(value):
+    """
+    Convert a Retry-After header (delta-seconds or HTTP date) to seconds from now, or None.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def from_config(http_config=None):
+    """
+    Build a RequestLayer from the http section of config.yaml.
+    """
+    http_config = http_config or {}
+    return RequestLayer(min_concurrency=http_config.get('min_concurrency', 1),
+                        max_concurrency=http_config.get('max_concurrency', 16),
+                        initial_concurrency=http_config.get('initial_concurrency', 4),
+                        requests_per_second=http_config.get('requests_per_second', 10),
+                        target_latency=http_config.get('target_latency', 2.0),
+                        max_retries=http_config.get('max_retries', 5),
+                        backoff_base=http_config.get('backoff_base', 1.0),
+                        backoff_max=http_config.get('backoff_max', 60),
+                        failure_queue=http_config.get('failure_queue', 'failed_requests.jsonl'))
@@ -1,291 +1,608 @@
 import requests
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 import os
 import json
-import pandas as pd
-import pdf_maker
-import datetime, time
-import yaml
-import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import async_crawler
+import http_cache as http_cache_module
+import fast_parser
+import request_layer
+import catalog as catalog_module
+import telemetry
 import sys
-import http.client as http_client  # Required for HTTP headers and logging
 
 pyfilename = os.path.basename(__file__).split(".")[0]
+# Shared HTTP client for the crawler and the PDF downloader (retries, adaptive rate, failure queue).
+# Replaced by configure() with one built from the http section of config.yaml
+http_layer = request_layer.RequestLayer()
+# On-disk response cache shared by every HTML fetch. Set up by configure() from the cache section of config.yaml
+http_cache = None
+# HTML extraction backend: "bs4" builds a full BeautifulSoup tree, "fast" streams the page through
+# fast_parser and keeps only anchors and the grade/topic banners. Set by configure() from config.yaml
+html_backend = "bs4"
+
+# Fetch a page through the response cache when it is enabled, otherwise straight from the network
+def fetch(url):
+    telemetry.metrics.count("html_pages_requested")
+    if http_cache is not None:
+        return http_cache.get(url)
+    response = http_layer.get(url)
+    response.raise_for_status()
+    telemetry.metrics.count("html_bytes_fetched", len(response.content))
+    return response
+
+# Re-issue every request that ended up in the failure queue on an earlier run.
+# PDFs go into the PDF store of the download section of config.yaml and are linked to the file they were
+# meant for; pages are re-fetched through fetch() so that they land in the response cache for the crawl that follows
+def replay_failed_requests(download_config=None):
+    entries = http_layer.failures.take()
+    if not entries:
+        return
+    telemetry.log(pyfilename, f"Replaying {len(entries)} failed requests")
+    store = None
+    for entry in entries:
+        filepath = entry.get("context", {}).get("filepath")
+        if filepath:
+            import pdf_maker
+            import pdf_store
+            if store is None:
+                store = pdf_store.PdfStore((download_config or {}).get('store', 'pdf_store'))
+            pdf_maker.download_pdf(entry["url"], filepath, layer=http_layer, store=store)
+            continue
+        try:
+            fetch(entry["url"])
+        except requests.exceptions.RequestException as e:
+            telemetry.log(pyfilename, f"Replay of {entry['url']} failed again: {e}")
+    if store is not None:
+        store.save()
+
+# Collect all links on a parsed page starting with the specified base URL
+def parse_links(soup, url, base_url):
+    links = set()
+    for a_tag in soup.find_all('a', href=True):
+        full_url = urljoin(url, a_tag['href'])
+        if full_url.startswith(base_url):
+            links.add(full_url)
+    return links
+
 # Function to get all links starting with the specified base URL
 def get_links(url, base_url):
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        links = set()
-
-        for a_tag in soup.find_all('a', href=True):
-            full_url = urljoin(url, a_tag['href'])
-            if full_url.startswith(base_url):
-                links.add(full_url)
+        response = fetch(url)
 
+        links, _ = parse_page(response.text, url, base_url=base_url)
         return links
     except requests.exceptions.RequestException as e:
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,f"Error fetching {url}: {e}")
+        telemetry.log(pyfilename, f"Error fetching {url}: {e}")
         return set()
 
-# Main function to crawl and collect links recursively
-def crawl_links(start_url, base_url, max_depth=2, depth=0, visited=None):
+# Counters reported by the crawl engines:
+#   fetched      - pages actually downloaded
+#   skipped      - new links found on the deepest level, recorded but not fetched
+#   deduplicated - links found again after they were already recorded
+def new_crawl_stats():
+    return {"fetched": 0, "skipped": 0, "deduplicated": 0}
+
+# Main function to crawl and collect links breadth-first
+# With a catalog.CrawlCheckpoint the frontier is saved periodically and an interrupted crawl resumes from it
+def crawl_links(start_url, base_url, max_depth=2, depth=0, visited=None, stats=None, fetch_links=None, checkpoint=None):
+    if fetch_links is None:
+        fetch_links = get_links
     if visited is None:
         visited = set()
-
-    if depth > max_depth:
-        return visited
-
-    links = get_links(start_url, base_url)
-
-    for link in links:
-        if link not in visited:
+    if stats is None:
+        stats = new_crawl_stats()
+
+    # URLs are marked when they are enqueued, so every page is fetched at most once
+    # and always at the shallowest depth it can be reached from
+    state = checkpoint.load() if checkpoint is not None else None
+    if state:
+        visited.update(state[0])
+        frontier = deque(state[1])
+    else:
+        frontier = deque([(start_url, depth)])
+    queued = {start_url} | {url for url, _ in frontier}
+
+    while frontier:
+        url, url_depth = frontier.popleft()
+        links = fetch_links(url, base_url)
+        stats["fetched"] += 1
+
+        for link in links:
+            if link in visited:
+                stats["deduplicated"] += 1
+                continue
             visited.add(link)
-            visited.update(crawl_links(link, base_url, max_depth, depth + 1, visited))
+            if url_depth >= max_depth:
+                stats["skipped"] += 1
+            elif link not in queued:
+                queued.add(link)
+                frontier.append((link, url_depth + 1))
+        if checkpoint is not None:
+            checkpoint.tick(visited, frontier)
+
+    if checkpoint is not None:
+        checkpoint.save(visited, [])
+    return visited
 
+# Pick the crawl engine configured in config.yaml (crawler: engine: sync|async)
+# fetch_links(url, base_url) downloads a page and returns its links. Defaults to get_links
+def crawl(start_url, base_url, max_depth=2, crawler_config=None, fetch_links=None, checkpoint=None):
+    crawler_config = crawler_config or {}
+    if fetch_links is None:
+        fetch_links = get_links
+    stats = new_crawl_stats()
+    if crawler_config.get('engine', 'sync') == 'async':
+        visited = async_crawler.crawl_links_async(start_url, base_url, fetch_links, max_depth=max_depth,
+                                                  workers=crawler_config.get('workers', 16),
+                                                  per_host=crawler_config.get('per_host', 8),
+                                                  requests_per_second=crawler_config.get('requests_per_second', 10),
+                                                  stats=stats, checkpoint=checkpoint)
+    else:
+        visited = crawl_links(start_url, base_url, max_depth=max_depth, stats=stats, fetch_links=fetch_links,
+                              checkpoint=checkpoint)
+    telemetry.log(pyfilename, f"Crawl of {start_url}: {stats['fetched']} fetched, {stats['skipped']} skipped, {stats['deduplicated']} deduplicated")
     return visited
 
-def extract_grades_topics_and_links(url,grade,subject,topic,pdf_base):
+# URL of listing page n: page 1 is the start URL itself, later ones are <start_url>/page/<n>
+def listing_page_url(start_url, page):
+    return start_url if page == 1 else f"{start_url}/page/{page}"
+
+# Worksheet links of a listing page, or an empty set if the page is past the last one (gone, or no worksheets).
+# Other fetch errors are raised: they say nothing about where the listing ends
+def listing_page_links(url, worksheet_base):
     try:
-        
-        # Fetch the webpage content
-        response = requests.get(url)
-        response.raise_for_status()  # Check for HTTP request errors
+        response = fetch(url)
+    except requests.exceptions.RequestException as e:
+        if page_gone(e):
+            return set()
+        raise
+    links, _ = parse_page(response.text, url, base_url=worksheet_base)
+    return links
+
+# Find the listing pages without crawling the whole listing: gallop (pages 2, 4, 8, ...) until a page is missing,
+# then binary search between the last page found and the first page missing, which takes O(log N) requests.
+# A probe that fails with anything but "gone" raises the error, rather than ending the listing early.
+# The links of every page fetched are kept in `shared_pages` for the L2 crawl, and the pages not probed
+# are fetched concurrently too when there is an L2 crawl or a response cache to take them.
+# Returns the listing page URLs in page order, or None if the start page itself lists no worksheets
+def discover_listing_pages(start_url, worksheet_base, workers=16, shared_pages=None):
+    probed = {}
+    def exists(page):
+        if page not in probed:
+            url = listing_page_url(start_url, page)
+            probed[page] = listing_page_links(url, worksheet_base)
+            if probed[page] and shared_pages is not None:
+                shared_pages[(url, worksheet_base)] = (probed[page], None)
+        return bool(probed[page])
+
+    if not exists(1):
+        return None
+    low, high = 1, 2
+    while exists(high):
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if exists(middle):
+            low = middle
+        else:
+            high = middle
+    telemetry.log(pyfilename, f"Last listing page of {start_url} is page {low}, found with {len(probed)} requests")
+
+    if shared_pages is not None or http_cache is not None:
+        def fetch_listing_page(page):
+            try:
+                return exists(page)
+            except requests.exceptions.RequestException as e:
+                telemetry.log(pyfilename, f"Listing page {page} of {start_url} could not be fetched: {e}")
+                return True
+        pages = [page for page in range(1, low + 1) if page not in probed]
+        with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+            list(pool.map(fetch_listing_page, pages))
+    return [listing_page_url(start_url, page) for page in range(1, low + 1)]
+
+# Delta recrawl: walk the listing pages from page 1 and fetch only worksheets the catalog does not know yet.
+# New worksheets are listed first, so the walk stops after `stop_after` listing pages in a row with nothing new
+# (or at the first listing page that cannot be fetched, past the last page).
+# Returns {listing page: status} and [(worksheet url, record JSON or None)] for the new worksheets
+def delta_crawl(start_url, worksheet_base, grade, pdf_base, known, stop_after=2, max_pages=None):
+    listing_pages = {}
+    new_worksheets = []
+    known_streak = 0
+    page = 1
+    while max_pages is None or page <= max_pages:
+        page_url = listing_page_url(start_url, page)
+        links, _, fetched = process_page(page_url, worksheet_base, grade, pdf_base)
+        if not fetched:
+            break
+        listing_pages[page_url] = "done"
+        new_links = sorted(set(links) - known)
+        if new_links:
+            known_streak = 0
+        else:
+            known_streak += 1
+            if known_streak >= stop_after:
+                break
+        for link in new_links:
+            _, record, fetched = process_page(link, worksheet_base, grade, pdf_base)
+            # A worksheet page that is gone is recorded with no record, so it is not looked at again
+            if fetched is not False:
+                new_worksheets.append((link, record))
+            known.add(link)
+        page += 1
+    telemetry.log(pyfilename, f"Delta crawl of {start_url}: {len(listing_pages)} listing pages checked, {len(new_worksheets)} new worksheet pages")
+    return listing_pages, new_worksheets
+
+# `grade` is one grade number ("3") or a list of them (batch runs); a worksheet is kept if it is tagged with any
+def grade_wanted(grades, grade):
+    wanted = [grade] if isinstance(grade, str) else grade
+    return any(("GRADE " + g) in grades for g in wanted)
+
+# Pull grades, subjects, topics and PDF links out of a parsed worksheet page.
+# Returns the record as JSON, or None if the page is not tagged with the requested grade
+def parse_worksheet(soup, url, grade, pdf_base):
+    # Extract Grades
+    grade_div = soup.find('div', class_='banner-grades mt-4')
+    grades = []
+    grade_present = False  # Initialize the flag for GRADE 3
+    if grade_div:
+        grade_links = grade_div.find_all('a', class_='badge playable-tag-banner js-ws-grade-tag')
+        grades = [link.text.strip() for link in grade_links]
+        grade_present = grade_wanted(grades, grade)  # Check if GRADE 3 is in the grades
+  
+    # Stop if GRADE 3 is not present
+    if not grade_present: # We don't want 2nd grade stuff. Okay if a higher grade is presnet.
+        return None # json.dumps({"info": "Grade 3 not applicable"}, indent=4)
+    # Extract Subject and Topics
+    topic_div = soup.find('div', class_='banner-subject-topics')
+    # print(topic_div)
+    """<div class="banner-subject-topics">
+        <div class="pt-2 text-center">
+        <a href="/math-worksheets">
+        <div class="badge playable-tag-banner playable-tag-banner-subject js-ws-subject-tag"> 
+                                    MATH WORKSHEETS
+                                </div>
+        </a>
+        </div>
+        <div class="pt-2 text-center">
+        <a class="badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-1" href="/math/data-handling-worksheets">
+                                        DATA HANDLING WORKSHEETS
+                                    </a>
+        </div>
+        </div>
+    """
+    subjects = []
+    topics = []
+    if topic_div:
+        subject_links = topic_div.find_all('div', class_='badge playable-tag-banner playable-tag-banner-subject js-ws-subject-tag')
+        subjects = [link.text.strip() for link in subject_links]
+        topic_links = topic_div.find_all('a', class_='badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-1')
+        topics = [link.text.strip() for link in topic_links]
+        # Extrat additional topics as well
+        topic_links = topic_div.find_all('a', class_='badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-2')  
+        topics.append([link.text.strip() for link in topic_links])
 
-        # Parse the HTML content
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Extract Grades
-        grade_div = soup.find('div', class_='banner-grades mt-4')
-        grades = []
-        grade_present = False  # Initialize the flag for GRADE 3
-        lower_grade_present = False
-        if grade_div:
-            grade_links = grade_div.find_all('a', class_='badge playable-tag-banner js-ws-grade-tag')
-            grades = [link.text.strip() for link in grade_links]
-            grade_present = ("GRADE "+ grade) in grades  # Check if GRADE 3 is in the grades
-            lower_grade_present = ("GRADE "+ str(int(grade)-1)) in grades  # Check if GRADE 2 is in the grades
-      
-        # Stop if GRADE 3 is not present
-        if not grade_present: # We don't want 2nd grade stuff. Okay if a higher grade is presnet.
-            return None # json.dumps({"info": "Grade 3 not applicable"}, indent=4)
-        # Extract Subject and Topics
-        topic_div = soup.find('div', class_='banner-subject-topics')
-        # print(topic_div)
-        """<div class="banner-subject-topics">
-            <div class="pt-2 text-center">
-            <a href="/math-worksheets">
-            <div class="badge playable-tag-banner playable-tag-banner-subject js-ws-subject-tag"> 
-                                        MATH WORKSHEETS
-                                    </div>
-            </a>
-            </div>
-            <div class="pt-2 text-center">
-            <a class="badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-1" href="/math/data-handling-worksheets">
-                                            DATA HANDLING WORKSHEETS
-                                        </a>
-            </div>
-            </div>
-        """
-        subjects = []
-        topics = []
-        if topic_div:
-            subject_links = topic_div.find_all('div', class_='badge playable-tag-banner playable-tag-banner-subject js-ws-subject-tag')
-            subjects = [link.text.strip() for link in subject_links]
-            topic_links = topic_div.find_all('a', class_='badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-1')
-            topics = [link.text.strip() for link in topic_links]
-            # Extrat additional topics as well
-            topic_links = topic_div.find_all('a', class_='badge playable-tag-banner playable-tag-banner-topics js-ws-topic-tag-2')  
-            topics.append([link.text.strip() for link in topic_links])
+    
+    pdf_links = []
+    for a_tag in soup.find_all('a', href=True):
+        full_url = urljoin(url, a_tag['href'])
+        if full_url.startswith(pdf_base):
+            pdf_links.append(full_url)
 
-        
-        pdf_links = []
-        for a_tag in soup.find_all('a', href=True):
-            full_url = urljoin(url, a_tag['href'])
-            if full_url.startswith(pdf_base):
-                pdf_links.append(full_url)
 
+    # Prepare JSON response
+    result = {
+        "grades": grades,
+        "subjects": subjects,
+        "topics": topics,
+        "pdf_links": pdf_links  # Include the extracted PDF links
+    }
 
-        # Prepare JSON response
-        result = {
-            "grades": grades,
-            "subjects": subjects,
-            "topics": topics,
-            "pdf_links": pdf_links  # Include the extracted PDF links
-        }
+    return json.dumps(result, indent=4)  # Return formatted JSON
 
-        return json.dumps(result, indent=4)  # Return formatted JSON
+def extract_grades_topics_and_links(url,grade,subject,topic,pdf_base):
+    try:
+        
+        # Fetch the webpage content (raises on HTTP request errors)
+        response = fetch(url)
+
+        # Parse the HTML content
+        _, record = parse_page(response.text, url, grade=grade, pdf_base=pdf_base)
+        return record
 
     except requests.RequestException as e:
         return json.dumps({"error": f"An error occurred while fetching the webpage: {e}"}, indent=4)
 
-# Function to flatten a list of lists
-
-
-def flatten_list(lst):
-    if isinstance(lst, list):
-        # Also, de-duplicate after flattening the list. This is required because the same PDF link can be present in multiple topics
-        return ', '.join(map(str, [item for sublist in lst for item in (sublist if isinstance(sublist, list) else [sublist])]))
-    return lst
-
-# Function to deduplicate a CSV file and overwrite the existing file
-def deduplicate_csv_file(file_name):
-    df_csv = pd.read_csv(file_name)
-    # drop duplicates after considering all columns
-    df_csv.drop_duplicates(inplace=True)
-    # Write the results to the file ad overwrite the existing file
-    df_csv.to_csv(file_name, mode='w', header=True, index=False)
-    return
-
-# Main code to crawl the website and collect links
-def main():
-
-    print(" ")
-    
-    # Ask the user if they want to do a test run or a full run
-    full_run = input("Do you want to do a full run? (y/n): ")
-    test_crawl = True
-    if full_run.lower() == "y":
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"Full run selected.")
-        test_crawl = False
+# True if a fetch error means the page is gone for good (a dead link): any 4xx but 408 and 429.
+# Retrying such a page on every later run would never succeed
+def page_gone(error):
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+# Fetch and parse a page once and return (outgoing links, worksheet record, fetched ok).
+# The record is None if the page does not carry the requested grade.
+# On a fetch error the page is reported with no links, no record and fetched ok = False,
+# or fetched ok = None if the page is gone for good, which callers record as final instead of retrying it.
+def process_page(url, base_url, grade, pdf_base):
+    try:
+        response = fetch(url)
+    except requests.exceptions.RequestException as e:
+        if page_gone(e):
+            telemetry.metrics.count("html_pages_gone")
+            telemetry.log(pyfilename, f"Skipping {url}, gone: {e}", event="page_gone", url=url, error=str(e))
+            return set(), None, None
+        telemetry.log(pyfilename, f"Error fetching {url}: {e}")
+        return set(), None, False
+
+    links, record = parse_page(response.text, url, base_url=base_url, grade=grade, pdf_base=pdf_base)
+    return links, record, True
+
+# fast_parser counterpart of parse_worksheet. Produces exactly the same JSON record
+def parse_worksheet_fast(page, url, grade, pdf_base):
+    if not grade_wanted(page.grades, grade):
+        return None
+    topics = list(page.topics)
+    if page.topic_div_found:
+        topics.append(list(page.extra_topics))
+    pdf_links = []
+    for href in page.hrefs:
+        full_url = urljoin(url, href)
+        if full_url.startswith(pdf_base):
+            pdf_links.append(full_url)
+    result = {
+        "grades": list(page.grades),
+        "subjects": list(page.subjects),
+        "topics": topics,
+        "pdf_links": pdf_links
+    }
+    return json.dumps(result, indent=4)
+
+# Parse a page once with the configured backend and return (links under base_url, worksheet record).
+# Either half is skipped when its arguments (base_url, or grade and pdf_base) are not given
+def parse_page(html, url, base_url=None, grade=None, pdf_base=None, backend=None):
+    backend = backend or html_backend
+    links = set()
+    record = None
+    if backend == "fast":
+        page = fast_parser.parse(html)
+        if base_url is not None:
+            for href in page.hrefs:
+                full_url = urljoin(url, href)
+                if full_url.startswith(base_url):
+                    links.add(full_url)
+        if grade is not None:
+            record = parse_worksheet_fast(page, url, grade, pdf_base)
     else:
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"Test run selected. L2 crawl will be limited to the first webpage.")
-        test_crawl = True
-
-
-    print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] , "Starting now")
-
-    # Config and secrets - Create objects to read config.yaml
-    with open("config.yaml", "r") as file_object:
-        config = yaml.load(file_object, Loader=yaml.SafeLoader)
-
-    # Set logging levels
-    log_level = config['default']['loglevel']  # Change to DEBUG for all troubleshooting
-    log_http_debug = config['default']['loghttpdebug']  # Change to TRUE if required to log HTTP headers
-    logging.basicConfig(stream=sys.stdout, format='%(asctime)s %(levelname)-8s %(message)s',
-                        datefmt='%Y%m%d %H:%M:%S', level=int(log_level), encoding='utf-8')
-    http_client.HTTPConnection.debuglevel = int(log_http_debug)
-    requests_log = logging.getLogger("requests.packages.urllib3")
-    requests_log.setLevel(int(log_level))
-    requests_log.propagate = True
-
-    # Write logs to both the logfile and stdout
-    class Logger(object):
-        def __init__(self):
-            self.terminal = sys.stdout
-            log_filename = f"logs/{pyfilename}_{str(datetime.datetime.today().date())}.log"
-            os.makedirs(os.path.dirname(log_filename), exist_ok=True)
-            self.log = open(log_filename, mode="a",
-                            encoding='utf8')
-
-        def write(self, message):
-            self.terminal.write(message)
-            self.log.write(message)
-
-        def flush(self):
-            # this flush method is needed for python 3 compatibility.
-            # this handles the flush command by doing nothing.
-            # you might want to specify some extra behavior here.
-            pass
-
-    sys.stdout = Logger()
-
-    # Extract configuration values
-    grade_filter = config['splashlearn']['grade'] # Grade to crawl
-    topic = config['splashlearn']['topic'] 
-    subject = config['splashlearn']['subject'] #Subject name is based on URL pattern. Options are math and ela.
+        from bs4 import BeautifulSoup  # Only loaded when the bs4 backend is used
+        soup = BeautifulSoup(html, 'html.parser')
+        if base_url is not None:
+            links = parse_links(soup, url, base_url)
+        if grade is not None:
+            record = parse_worksheet(soup, url, grade, pdf_base)
+    return links, record
+
+# Crawl one grade/subject target into the catalog: delta check, L1 listing pages and L2 worksheets.
+# `grades` are the grade numbers whose worksheets are kept (every grade of the batch, so that a worksheet page
+# tagged with several grades is fetched once and serves all of them). `shared_pages` maps (url, base_url) to the
+# (links, record) of pages already fetched in this run. `levels` picks the crawl levels to run: 1 finds the
+# listing pages (the crawl stage), 2 crawls them for worksheet pages and extracts those (the extract stage)
+def collect_worksheets(catalog, config, grade_filter, subject, grades, test_crawl, shared_pages=None, levels=(1, 2)):
+    if shared_pages is None:
+        shared_pages = {}
     website = config['splashlearn']['website'] # Website to crawl
-    grade = grade_filter.split("rd")[0]
+    grade = grade_number(grade_filter)
+    grade_label = "GRADE " + grade
     start_url = website + "/" + subject +"-worksheets" + "-for-" + grade_filter + "-graders"
     base_url =  start_url
+    worksheet_base = target_worksheet_base(config, subject) # Worksheets have this URL pattern
+    pdf_base = config['splashlearn']['pdf_base'] # PDFs have this URL pattern
+    crawler_config = config.get('crawler') or {}
     visited = None
     links = None
 
-    # WGET and other crawls don't work well with this site. So, we will crawl the site and save the links to a file
+    # Carry over the intermediate files of runs made before the catalog existed
+    webpages_file = f"{grade_filter}_grade_{subject}_webpages.txt"
+    metadata_file = f"{grade_filter}_grade_{subject}_pdf_metadata.csv"
+    if not catalog.pages(1, grade_filter, subject) and os.path.exists(webpages_file):
+        catalog.import_webpages(webpages_file, grade_filter, subject)
+    if not catalog.worksheet_count(grade_label, subject) and os.path.exists(metadata_file):
+        catalog.import_csv(metadata_file)
+        # The CSV was only ever written by a finished L2 crawl
+        catalog.set_status({url: "done" for url in catalog.pages(1, grade_filter, subject)}, 1, grade_filter, subject)
+    # Crawl frontiers and worksheet progress are saved every `checkpoint_every` pages, so an interrupted run resumes
+    checkpoint_every = crawler_config.get('checkpoint_every', 50)
+
+    # Delta mode: once a full crawl has completed, only look for worksheets added since.
+    # The L1 and L2 stages below then find nothing left to do
+    if 1 in levels and crawler_config.get('mode', 'full') == 'delta' and catalog.pages(1, grade_filter, subject) \
+            and not catalog.pending_pages(1, grade_filter, subject):
+        known = catalog.worksheet_urls() | catalog.done_pages(2, grade_filter, subject)
+        listing_pages, new_worksheets = delta_crawl(start_url, worksheet_base, grades,
+                                                    pdf_base, known,
+                                                    stop_after=crawler_config.get('delta_stop_after', 2))
+        catalog.add_pages(listing_pages, 1, grade_filter, subject)
+        catalog.set_status(listing_pages, 1, grade_filter, subject)
+        catalog.add_worksheets([(link, json.loads(record)) for link, record in new_worksheets if record])
+        catalog.set_status({link: "done" for link, _ in new_worksheets}, 2, grade_filter, subject)
+        for link, record in new_worksheets:
+            if record:
+                telemetry.log(pyfilename, f"New worksheet: {link}")
+
+    # WGET and other crawls don't work well with this site. So, we will find the listing pages and save them to the catalog
     # This is the first level crawl
 
-    # Do this if the file is not already created or is empty
-    if not os.path.exists(f"{grade_filter}_grade_{subject}_webpages.txt") or os.path.getsize(f"{grade_filter}_grade_{subject}_webpages.txt") == 0:
-        visited = crawl_links(start_url, base_url, max_depth=3)
-        # Visited links have a page number at the end (e.g., https://www.splashlearn.com/math-worksheets-for-3rd-graders/page/3) Get the highest page number
-        # and then create links for all the missing pages and add to visited\
-        # Get the highest page number
-        max_page = 1
-        for link in visited:
-            if "page" in link:
-                page = int(link.split("page/")[1])
-                if page > max_page:
-                    max_page = page
-        # Create links for all the missing pages and add to visited and reorder by page number
-
-        for page in range(2, max_page+1):
-            visited.add(f"{start_url}/page/{page}")
-        # Sort the links by page number but remember page number is a string
-        visited = sorted(visited, key=lambda x: int(x.split("page/")[1]) if "page" in x else 0)
-        # Write the results to the file
-        with open(f"{grade_filter}_grade_{subject}_webpages.txt", "w") as f:
+    # Do this if the catalog holds no listing pages for this grade and subject yet
+    if 1 in levels and not catalog.pages(1, grade_filter, subject):
+        checkpoint = catalog_module.CrawlCheckpoint(catalog, f"L1 {start_url}", checkpoint_every)
+        # Probe the pagination for the last listing page. If a probe fails, nothing is stored and the next run probes again
+        try:
+            visited = discover_listing_pages(start_url, worksheet_base, workers=crawler_config.get('workers', 16),
+                                             shared_pages=shared_pages if 2 in levels else None)
+        except requests.exceptions.RequestException as e:
+            telemetry.log(pyfilename, f"Listing discovery of {start_url} stopped, the L1 crawl runs again next time: {e}")
+            visited = []
+        if visited is None:
+            # The listing does not look as expected, so crawl it instead
+            telemetry.log(pyfilename, "Pagination probing found no worksheets. Crawling the listing instead")
+            visited = crawl(start_url, base_url, max_depth=3, crawler_config=crawler_config, checkpoint=checkpoint)
+            # Visited links have a page number at the end (e.g., https://www.splashlearn.com/math-worksheets-for-3rd-graders/page/3) Get the highest page number
+            # and then create links for all the missing pages and add to visited\
+            # Get the highest page number
+            max_page = 1
             for link in visited:
-                #restrict links to those that have the grade_filter in the URL
-                if grade_filter in link:
-                    f.write(f"{link}\n")
-                    print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,f"Crawled L1: {link}")
-        # Print the total number of links collected in the file
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"Total number of L1 pages crawled:", len(set(visited)))
-
-    df = pd.DataFrame(columns=['grades', 'subjects', 'topics', 'pdf_links'])
-    
+                if "page" in link:
+                    page = int(link.split("page/")[1])
+                    if page > max_page:
+                        max_page = page
+            # Create links for all the missing pages and add to visited and reorder by page number
+
+            for page in range(2, max_page+1):
+                visited.add(f"{start_url}/page/{page}")
+            # Sort the links by page number but remember page number is a string
+            visited = sorted(visited, key=lambda x: int(x.split("page/")[1]) if "page" in x else 0)
+        #restrict links to those that have the grade_filter in the URL
+        visited = [link for link in visited if grade_filter in link]
+        catalog.add_pages(visited, 1, grade_filter, subject)
+        checkpoint.clear()
+        for link in visited:
+            telemetry.log(pyfilename, f"Crawled L1: {link}")
+        # Print the total number of links collected in the catalog
+        telemetry.log(pyfilename, "Total number of L1 pages crawled:", len(set(visited)))
+
     # Next level crawl
-    # For each page in the grade_filter+grade+topic links.txt file, get the links to each worksheet page which will have a base url of "https://www.splashlearn.com/s/math-worksheets/" and write the results to a file called grade_filter + +grade+topic+math+worksheets+pages.txt
-    # Do this if the file is not already created or is empty
-    if not os.path.exists(f"{grade_filter}_grade_{subject}_pdf_metadata.csv") or os.path.getsize(f"{grade_filter}_grade_{subject}_pdf_metadata.csv") == 0:
+    # For each L1 page in the catalog, get the links to each worksheet page which will have a base url of "https://www.splashlearn.com/s/math-worksheets/" and add the worksheets to the catalog
+    # Every L1 page and worksheet page has a status in the catalog. Pages that are not done yet (never crawled,
+    # interrupted or failed) are crawled, resuming from the checkpointed frontier of an interrupted crawl
+    pending_pages = catalog.pending_pages(1, grade_filter, subject) if 2 in levels else []
+    # With the work queue enabled, the listing pages are shared out between every worker running this stage
+    # (other processes, or other hosts using the same catalog). Each one claims a few pages at a time
+    work_queue = catalog_module.work_queue(catalog, f"L2 {grade_filter} {subject}", config.get('queue')) if pending_pages else None
+    if work_queue is not None:
+        # A new run only hands out the listing pages the catalog still has pending
+        work_queue.reset(pending_pages)
+        work_queue.add(pending_pages)
+        pending_pages = (page_url for page_url, _ in work_queue.items())
+    if pending_pages:
         visited = None
         links = None
-        with open(f"{grade_filter}_grade_{subject}_webpages.txt", "r") as f:
-            for line in f:
-                page_url = line.strip()
-                print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] , "L2 crawling page:", page_url)
-                worksheet_base = config['splashlearn']['worksheet_base'] # Worksheets have this URL pattern
-                pdf_base = config['splashlearn']['pdf_base'] # PDFs have this URL pattern
-                visited = crawl_links(page_url, worksheet_base, max_depth=2) # Only need the math worksheets page links which would have the same URL pattern for base_url
-                # De-duplicate the links
-                visited = set(visited)
-                print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"Total number of math worksheets pages collected:", len(set(visited)))
-                count = 0
-                for link in visited:
-                    # Extract the topic, grade and PDF link from the URL and include it in the file as comma delimited
-                    print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,f"Crawled L2: {link}")
-                    grade_subject_links = extract_grades_topics_and_links(link,grade,subject,topic,pdf_base)
-                    # Write to data only if it's not None
-                    if grade_subject_links:
-                        data = json.loads(grade_subject_links)
-                        df = pd.json_normalize(data)
-                        for column in df.columns:
-                            if isinstance(df[column][0], list):
-                                df[column] = df[column].apply(flatten_list)
-
-                    # Write the results to the file
-                        df.to_csv(f"{grade_filter}_grade_{subject}_pdf_metadata.csv", mode='a', header=False, index=False)
-                    count += 1
-                    if test_crawl and count > 10:
-                        break
-                # Stop if test crawl
-                if test_crawl:
+        # Worksheets catalogued for any target are not extracted again
+        worksheets_done = catalog.done_pages(2, grade_filter, subject) | catalog.worksheet_urls()
+        for page_url in pending_pages:
+            telemetry.log(pyfilename, "L2 crawling page:", page_url)
+            # Every page fetched during the crawl is parsed once for both its links and its worksheet metadata,
+            # so the extraction below only needs to fetch pages the crawl recorded but did not download.
+            # Either way each page is fetched at most once per run, whichever target needs it first
+            worksheet_records = {}
+            failed_pages = set()
+            def fetch_page(url, base_url):
+                # Pages already fetched for another target in this run are not fetched again
+                if (url, base_url) in shared_pages:
+                    links, record = shared_pages[(url, base_url)]
+                    return links, record, True
+                links, record, fetched = process_page(url, base_url, grades, pdf_base)
+                if fetched is not False:
+                    shared_pages[(url, base_url)] = (links, record)
+                return links, record, fetched
+            def fetch_worksheet_links(url, base_url):
+                links, record, fetched = fetch_page(url, base_url)
+                if fetched is not False:
+                    worksheet_records[url] = record
+                else:
+                    failed_pages.add(url)
+                return links
+            checkpoint = catalog_module.CrawlCheckpoint(catalog, f"L2 {page_url}", checkpoint_every)
+            visited = crawl(page_url, worksheet_base, max_depth=2, crawler_config=crawler_config,
+                            fetch_links=fetch_worksheet_links, checkpoint=checkpoint) # Only need the math worksheets page links which would have the same URL pattern for base_url
+            # De-duplicate the links
+            visited = set(visited)
+            telemetry.log(pyfilename, "Total number of math worksheets pages collected:", len(set(visited)))
+            count = 0
+            batch = []
+            statuses = {}
+            worksheet_failed = False
+            for link in visited:
+                count += 1
+                if test_crawl and count > 11:
                     break
-    # Print the total number of links collected in the file
-        print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"Total number of PDFs collected in the dataframe:", len(df) )
-
-    print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"Beggining PDF download and consolidation")
-    
-    # deduplicate the CSV file
-    deduplicate_csv_file(f"{grade_filter}_grade_{subject}_pdf_metadata.csv")
-
-    # sleep for 0.5 seconds to allow the file to be closed
-    time.sleep(0.5)
-    pdf_maker.build_pdf(f"{grade_filter}_grade_{subject}_pdf_metadata.csv", f"{grade_filter}_grade_{subject}_consolidated_PDFs.pdf")
-    print(pyfilename, datetime.datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-5] ,"All done. Consolidated PDFs are in the file", f"{grade_filter}_grade_{subject}_consolidated_PDFs.pdf")
+                if link in worksheets_done:
+                    continue
+                # Extract the topic, grade and PDF link from the URL
+                telemetry.log(pyfilename, f"Crawled L2: {link}")
+                fetched = True
+                if link in worksheet_records:
+                    grade_subject_links = worksheet_records[link]
+                else:
+                    _, grade_subject_links, fetched = fetch_page(link, worksheet_base)
+                # Keep the record only if it's not None and the page could be fetched.
+                # Only transient errors fail the worksheet: a page that is gone for good is done, with no record
+                statuses[link] = "done"
+                if fetched is False:
+                    statuses[link] = "failed"
+                    worksheet_failed = True
+                elif grade_subject_links:
+                    batch.append((link, json.loads(grade_subject_links)))
+                # Save progress every checkpoint_every worksheets
+                if len(statuses) >= checkpoint_every:
+                    catalog.add_worksheets(batch)
+                    catalog.set_status(statuses, 2, grade_filter, subject)
+                    worksheets_done.update(url for url, status in statuses.items() if status == "done")
+                    batch, statuses = [], {}
+            catalog.add_worksheets(batch)
+            catalog.set_status(statuses, 2, grade_filter, subject)
+            worksheets_done.update(url for url, status in statuses.items() if status == "done")
+            # Stop if test crawl. The page stays pending, so a later run picks it up again
+            if test_crawl:
+                break
+            # The listing page is done once its crawl and all its worksheets succeeded.
+            # A crawl that lost pages is started afresh next time; otherwise only the failed worksheets are retried
+            if failed_pages or worksheet_failed:
+                catalog.set_status({page_url: "failed"}, 1, grade_filter, subject)
+                if failed_pages:
+                    checkpoint.clear()
+            else:
+                catalog.set_status({page_url: "done"}, 1, grade_filter, subject)
+                checkpoint.clear()
+            # The catalog status above decides whether a later run crawls the page again
+            if work_queue is not None:
+                work_queue.complete([page_url])
+        if work_queue is not None:
+            work_queue.close()
+        # Print the total number of worksheets collected in the catalog
+        telemetry.log(pyfilename, "Total number of worksheets in the catalog:", catalog.worksheet_count(grade_label, subject))
+
+
+# Grade number of a grade name used in URLs: 3rd -> 3
+def grade_number(grade_filter):
+    return "".join(ch for ch in grade_filter if ch.isdigit())
+
+# Worksheet pages of a subject live under <website>/s/<subject>-worksheets
+def target_worksheet_base(config, subject):
+    if subject == config['splashlearn']['subject']:
+        return config['splashlearn']['worksheet_base']
+    return config['splashlearn']['website'] + "/s/" + subject + "-worksheets"
+
+# Set the HTML backend, the shared request layer and the response cache from config.yaml
+def configure(config):
+    global http_cache, html_backend, http_layer
+    html_backend = (config.get('parser') or {}).get('backend', 'bs4')
+    http_layer = request_layer.from_config(config.get('http'))
+
+    # Re-use responses from previous runs. Stale pages are revalidated with conditional GETs
+    cache_config = config.get('cache') or {}
+    if cache_config.get('enabled', 0):
+        http_cache = http_cache_module.HttpCache(cache_dir=cache_config.get('dir', 'http_cache'),
+                                                 ttl=cache_config.get('ttl', 3600),
+                                                 max_age=cache_config.get('max_age', 30 * 86400),
+                                                 max_bytes=cache_config.get('max_mb', 500) * 1024 * 1024,
+                                                 session=http_layer)
+
+# The command line lives in cli.py, which only imports the modules a stage needs.
+# Running this file runs every stage, as `python cli.py all` would
+def main():
+    import cli
+    cli.main(sys.argv[1:] or ["all"])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import bisect
+import logging
+import logging.handlers
+import threading
+import datetime
+import http.client as http_client
+from collections import Counter
+from contextlib import contextmanager
+
+pyfilename = os.path.basename(__file__).split(".")[0]
+
+# Upper bounds, in seconds, of the request latency histogram buckets. The last bucket is open-ended
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger("splashlearn")
+# The queue listener is owned by the process that called setup(). Worker processes print directly
+listener = None
+listener_pid = None
+
+
+def timestamp(when=None):
+    """
+    The repo's status-line timestamp: YYYYmmdd HH:MM:SS.f (UTC).
+    """
+    when = datetime.datetime.utcfromtimestamp(when) if when is not None else datetime.datetime.utcnow()
+    return when.strftime("%Y%m%d %H:%M:%S.%f")[:-5]
+
+
+class Metrics:
+    """
+    Thread-safe measurements of one run:
+      - counters (requests, retries, cache hits, bytes downloaded, pages merged, ...)
+      - per-stage wall-clock timers; a stage nested in a stage of the same name is only timed once
+      - histograms with fixed buckets (request latency)
+    summary() derives the rates (cache hit rate, MB/s downloaded, PDF pages merged/s) and dump() writes it as JSON.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = Counter()
+            self.stages = {}
+            self.active = Counter()
+            self.histograms = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"buckets": list(buckets), "counts": [0] * (len(buckets) + 1),
+                                                     "count": 0, "sum": 0.0, "max": 0.0}
+            histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["max"] = max(histogram["max"], value)
+
+    @contextmanager
+    def stage(self, name):
+        with self.lock:
+            outermost = not self.active[name]
+            self.active[name] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                self.active[name] -= 1
+                if outermost:
+                    stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+                    stage["seconds"] += seconds
+                    stage["calls"] += 1
+
+    def snapshot(self):
+        """
+        Counters and histograms as plain data, for a worker process to send back to its parent.
+        """
+        with self.lock:
+            return {"counters": dict(self.counters), "histograms": json.loads(json.dumps(self.histograms))}
+
+    def merge(self, snapshot):
+        """
+        Add a worker's snapshot. Stage times are not merged: the parent times the whole parallel stage.
+        """
+        with self.lock:
+            self.counters.update(snapshot["counters"])
+            for name, theirs in snapshot["histograms"].items():
+                ours = self.histograms.setdefault(name, {"buckets": theirs["buckets"], "counts": [0] * len(theirs["counts"]),
+                                                         "count": 0, "sum": 0.0, "max": 0.0})
+                ours["counts"] = [a + b for a, b in zip(ours["counts"], theirs["counts"])]
+                ours["count"] += theirs["count"]
+                ours["sum"] += theirs["sum"]
+                ours["max"] = max(ours["max"], theirs["max"])
+
+    def summary(self):
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {name: {"seconds": round(stage["seconds"], 3), "calls": stage["calls"]} for name, stage in self.stages.items()}
+            histograms = {name: summarize_histogram(histogram) for name, histogram in self.histograms.items()}
+            started = self.started
+
+        def per_second(amount, stage):
+            seconds = (stages.get(stage) or {}).get("seconds")
+            return round(amount / seconds, 2) if seconds else None
+
+        lookups = sum(counters.get(name, 0) for name in ("cache_hits", "cache_revalidated", "cache_misses"))
+        rates = {
+            "cache_hit_rate": round((counters.get("cache_hits", 0) + counters.get("cache_revalidated", 0)) / lookups, 3) if lookups else None,
+            "download_mb_per_second": per_second(counters.get("pdf_bytes_downloaded", 0) / (1024 * 1024), "download"),
+            "pdfs_prepared_per_second": per_second(counters.get("pdfs_prepared", 0), "stamping"),
+            "pdf_pages_merged_per_second": per_second(counters.get("pdf_pages_merged", 0), "merge"),
+        }
+        return {
+            "started_at": timestamp(started),
+            "seconds": round(time.time() - started, 3),
+            "stages": stages,
+            "rates": rates,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def dump(self, path):
+        summary = self.summary()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".temp", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        os.replace(path + ".temp", path)
+        return summary
+
+
+def summarize_histogram(histogram):
+    """
+    Bucket counts keyed by their bounds ("<=0.5", ..., ">30.0"), with the mean, max and estimated percentiles.
+    A percentile is reported as the upper bound of the bucket it falls in.
+    """
+    buckets, counts, total = histogram["buckets"], histogram["counts"], histogram["count"]
+
+    def percentile(fraction):
+        seen = 0
+        for bound, count in zip(buckets + [histogram["max"]], counts):
+            seen += count
+            if seen >= fraction * total:
+                return bound
+        return histogram["max"]
+
+    labels = [f"<={bound}" for bound in buckets] + [f">{buckets[-1]}"]
+    return {
+        "count": total,
+        "mean": round(histogram["sum"] / total, 4) if total else None,
+        "max": round(histogram["max"], 4),
+        "p50": percentile(0.5) if total else None,
+        "p90": percentile(0.9) if total else None,
+        "p99": percentile(0.99) if total else None,
+        "buckets": dict(zip(labels, counts)),
+    }
+
+
+metrics = Metrics()
+
+
+class LineFormatter(logging.Formatter):
+    """
+    The repo's usual status line: <module> <timestamp> <message>, stamped when the event happened.
+    """
+
+    def format(self, record):
+        line = f"{getattr(record, 'source', record.name)} {timestamp(record.created)} {record.getMessage()}"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per event: time, level, source, event name, message and the event's fields.
+    """
+
+    def format(self, record):
+        event = {"time": timestamp(record.created), "level": record.levelname, "source": getattr(record, "source", record.name),
+                 "event": getattr(record, "event", None) or "log", "message": record.getMessage()}
+        event.update(getattr(record, "fields", None) or {})
+        return json.dumps(event, default=str)
+
+
+def log(source, *parts, event=None, level=logging.INFO, **fields):
+    """
+    Emit a status line from `source` (the calling module's pyfilename). `parts` are joined like print's arguments.
+    `event` names the event and `fields` are kept as structured data in the JSON-lines log.
+    Once setup() has run, the record is queued and written by the background listener; before that,
+    and in worker processes, the line is printed directly.
+    """
+    message = " ".join(str(part) for part in parts)
+    if listener_pid != os.getpid():
+        print(source, timestamp(), message)
+        return
+    logger.log(level, message, extra={"source": source, "event": event, "fields": fields})
+
+
+def setup(log_level=logging.INFO, log_http_debug=0, log_dir="logs", name="splashLearn"):
+    """
+    Route logging through a queue drained by one background thread, which writes to the terminal,
+    to logs/<name>_<date>.log and, as JSON lines, to logs/<name>_<date>.jsonl. The hot loops only pay for a queue put.
+    urllib3's per-connection DEBUG lines are kept out unless `log_http_debug` is set.
+    The metrics summary is written to logs/<name>_<start time>_metrics.json at exit; its path is returned.
+    """
+    global listener, listener_pid
+    if listener is not None:
+        shutdown()
+    log_level = int(log_level)
+    os.makedirs(log_dir, exist_ok=True)
+    now = datetime.datetime.today()
+
+    terminal = logging.StreamHandler(sys.stdout)
+    terminal.setFormatter(LineFormatter())
+    text_file = logging.FileHandler(os.path.join(log_dir, f"{name}_{now.date()}.log"), encoding="utf-8")
+    text_file.setFormatter(LineFormatter())
+    events_file = logging.FileHandler(os.path.join(log_dir, f"{name}_{now.date()}.jsonl"), encoding="utf-8")
+    events_file.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(log_level)
+    logging.getLogger("urllib3").setLevel(log_level if log_http_debug else max(log_level, logging.WARNING))
+    http_client.HTTPConnection.debuglevel = int(log_http_debug)
+
+    listener = logging.handlers.QueueListener(records, terminal, text_file, events_file)
+    listener.start()
+    listener_pid = os.getpid()
+
+    metrics_path = os.path.join(log_dir, f"{name}_{now.strftime('%Y%m%d_%H%M%S')}_metrics.json")
+    atexit.register(shutdown, metrics_path)
+    return metrics_path
+
+
+def shutdown(metrics_path=None):
+    """
+    Write the metrics summary (if a path is given), then drain the queue and stop the writer thread.
+    Safe to call more than once.
+    """
+    global listener, listener_pid
+    if metrics_path and listener_pid == os.getpid():
+        summary = metrics.dump(metrics_path)
+        for stage, timing in summary["stages"].items():
+            log(pyfilename, f"{stage}: {timing['seconds']:.2f}s", event="stage", stage=stage, **timing)
+        log(pyfilename, f"Run metrics written to {metrics_path}", event="metrics", path=metrics_path, **summary["rates"])
+    if listener is not None and listener_pid == os.getpid():
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        logging.getLogger().handlers = []
+    listener = None
+    listener_pid = None
+
+
+def call_with_metrics(function, *args):
+    """
+    Run function(*args) in a worker process with fresh metrics and return (result, metrics snapshot),
+    so the parent can merge what the worker counted (see Metrics.merge).
+    """
+    metrics.reset()
+    result = function(*args)
+    return result, metrics.snapshot()
@@ -0,0 +1,55 @@
+import os
+import fitz
+import catalog as catalog_module
+import pdf_maker
+
+WORKSHEETS = [
+    # (worksheet url, subject, topics, pdf link)
+    ("https://example.com/s/math-worksheets/add-fractions", "MATH WORKSHEETS", ["FRACTIONS WORKSHEETS"],
+     "https://example.com/worksheet_uploads/pdf/s/add-fractions.pdf"),
+    ("https://example.com/s/math-worksheets/tell-time", "MATH WORKSHEETS", ["TIME WORKSHEETS"],
+     "https://example.com/worksheet_uploads/pdf/s/tell-time.pdf"),
+    ("https://example.com/s/ela-worksheets/identify-nouns", "ELA WORKSHEETS", ["NOUNS WORKSHEETS"],
+     "https://example.com/worksheet_uploads/pdf/s/identify-nouns.pdf"),
+]
+
+
+def write_worksheet_pdf(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 100), text)
+    doc.save(path)
+    doc.close()
+
+
+def test_books_of_one_grade_hold_only_their_own_subject(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    catalog = catalog_module.Catalog("catalog.db")
+    catalog.add_worksheets([(url, {"grades": ["GRADE 3"], "subjects": [subject], "topics": topics, "pdf_links": [link]})
+                            for url, subject, topics, link in WORKSHEETS])
+    # Already downloaded, so the books are built offline
+    for _, _, topics, link in WORKSHEETS:
+        write_worksheet_pdf(pdf_maker.worksheet_pdf_path(topics[0], link, "GRADE 3"), topics[0])
+
+    books = [("GRADE 3", "math", "3rd_grade_math.pdf"), ("GRADE 3", "ela", "3rd_grade_ela.pdf")]
+    pdf_maker.build_pdfs(catalog, books, preprocess_config={"workers": 1}, workers=1, download=False)
+
+    def book_topics(path):
+        with fitz.open(path) as doc:
+            return {title for level, title, _ in doc.get_toc() if level == 1}
+
+    assert book_topics("3rd_grade_math.pdf") == {"FRACTIONS WORKSHEETS", "TIME WORKSHEETS"}
+    assert book_topics("3rd_grade_ela.pdf") == {"NOUNS WORKSHEETS"}
+    catalog.close()
+
+
+def test_catalog_rows_are_filtered_by_subject(tmp_path):
+    catalog = catalog_module.Catalog(str(tmp_path / "catalog.db"))
+    catalog.add_worksheets([(url, {"grades": ["GRADE 3"], "subjects": [subject], "topics": topics, "pdf_links": [link]})
+                            for url, subject, topics, link in WORKSHEETS])
+    math_links = [row[0] for row in pdf_maker.catalog_worksheet_rows(catalog, "GRADE 3", "math")]
+    ela_links = [row[0] for row in pdf_maker.catalog_worksheet_rows(catalog, "GRADE 3", "ela")]
+    assert math_links == [WORKSHEETS[0][3], WORKSHEETS[1][3]]
+    assert ela_links == [WORKSHEETS[2][3]]
+    assert len(pdf_maker.catalog_worksheet_rows(catalog, "GRADE 3")) == 3
+    catalog.close()
@@ -0,0 +1,67 @@
+import catalog as catalog_module
+import splashLearn
+
+CONFIG = {"splashlearn": {"website": "https://www.splashlearn.com", "subject": "math",
+                          "worksheet_base": "https://www.splashlearn.com/s/math-worksheets",
+                          "pdf_base": "https://www.splashlearn.com/worksheet_uploads/pdf/s/"}}
+
+
+def worksheet(grades, subject, topics, link):
+    return {"grades": grades, "subjects": [subject], "topics": topics, "pdf_links": [link]}
+
+
+def test_worksheet_count_by_grade_and_subject(tmp_path):
+    catalog = catalog_module.Catalog(str(tmp_path / "catalog.db"))
+    catalog.add_worksheets([
+        ("https://example.com/s/math-worksheets/a", worksheet(["GRADE 3"], "MATH WORKSHEETS", ["FRACTIONS WORKSHEETS"], "a.pdf")),
+        ("https://example.com/s/math-worksheets/b", worksheet(["GRADE 3", "GRADE 4"], "MATH WORKSHEETS", ["TIME WORKSHEETS"], "b.pdf")),
+        ("https://example.com/s/ela-worksheets/c", worksheet(["GRADE 3"], "ELA WORKSHEETS", ["NOUNS WORKSHEETS"], "c.pdf")),
+    ])
+    assert catalog.worksheet_count() == 3
+    assert catalog.worksheet_count("GRADE 3") == 3
+    assert catalog.worksheet_count("GRADE 3", "math") == 2
+    assert catalog.worksheet_count("GRADE 3", "ela") == 1
+    assert catalog.worksheet_count("GRADE 4", "ela") == 0
+    assert catalog.worksheet_count(subject="MATH WORKSHEETS") == 2
+    catalog.close()
+
+
+def test_legacy_csv_of_a_second_subject_is_imported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    catalog = catalog_module.Catalog("catalog.db")
+    catalog.add_worksheets([
+        ("https://example.com/s/math-worksheets/a", worksheet(["GRADE 3"], "MATH WORKSHEETS", ["FRACTIONS WORKSHEETS"], "a.pdf")),
+    ])
+    (tmp_path / "3rd_grade_ela_webpages.txt").write_text("https://www.splashlearn.com/ela-worksheets-for-3rd-graders\n")
+    (tmp_path / "3rd_grade_ela_pdf_metadata.csv").write_text('GRADE 3,ELA WORKSHEETS,NOUNS WORKSHEETS,https://example.com/nouns.pdf\n')
+
+    # No crawl levels: only the carry-over of the legacy files runs
+    splashLearn.collect_worksheets(catalog, CONFIG, "3rd", "ela", ["3"], test_crawl=False, levels=())
+
+    assert catalog.worksheet_count("GRADE 3", "ela") == 1
+    # The CSV was written by a finished crawl, so its listing pages are not crawled again
+    assert catalog.pending_pages(1, "3rd", "ela") == []
+    catalog.close()
+
+
+def test_work_queue_add_keeps_finished_items_until_reset(tmp_path):
+    catalog = catalog_module.Catalog(str(tmp_path / "catalog.db"))
+    queue = catalog_module.WorkQueue(catalog, "downloads", batch=10)
+    queue.add({"a.pdf": 1, "b.pdf": 2})
+    claimed = queue.claim()
+    queue.complete([key for key, _ in claimed])
+
+    # A worker joining late queues the same items: they stay done
+    late = catalog_module.WorkQueue(catalog, "downloads")
+    late.add({"a.pdf": 1, "b.pdf": 2, "c.pdf": 3})
+    assert late.counts() == {"done": 2, "pending": 1}
+    # No reset while the run still has pending items
+    assert late.reset() == 0
+
+    late.complete([key for key, _ in late.claim()])
+    # The next run queues everything again
+    assert queue.reset() == 3
+    assert queue.counts() == {"pending": 3}
+    queue.close()
+    late.close()
+    catalog.close()
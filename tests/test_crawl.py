@@ -0,0 +1,149 @@
+import os
+import requests
+import catalog as catalog_module
+import splashLearn
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+WEBSITE = "https://www.splashlearn.com"
+WORKSHEET_BASE = WEBSITE + "/s/math-worksheets"
+LISTING = WEBSITE + "/math-worksheets-for-3rd-graders"
+CONFIG = {"splashlearn": {"website": WEBSITE, "subject": "math", "worksheet_base": WORKSHEET_BASE,
+                          "pdf_base": WEBSITE + "/worksheet_uploads/pdf/s/"}}
+
+
+def listing(*slugs):
+    return "<html><body>" + "".join(f'<a href="/s/math-worksheets/{slug}">{slug}</a>' for slug in slugs) + "</body></html>"
+
+
+def worksheet():
+    with open(os.path.join(FIXTURES, "worksheet_page.html"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+class FakeSite:
+    """
+    Stands in for splashLearn.fetch: serves `pages` (url -> HTML), answers `statuses` (url -> HTTP status)
+    with an HTTPError and any other URL with a 404. Records every URL fetched.
+    """
+
+    def __init__(self, pages, statuses=None):
+        self.pages = pages
+        self.statuses = statuses or {}
+        self.fetched = []
+
+    def __call__(self, url, *args, **kwargs):
+        self.fetched.append(url)
+        if url in self.pages:
+            response = requests.Response()
+            response.status_code = 200
+            response._content = self.pages[url].encode("utf-8")
+            response.encoding = "utf-8"
+            return response
+        response = requests.Response()
+        response.status_code = self.statuses.get(url, 404)
+        response.url = url
+        raise requests.HTTPError(f"{response.status_code} Error for url: {url}", response=response)
+
+
+def extract(catalog, config=CONFIG):
+    splashLearn.collect_worksheets(catalog, config, "3rd", "math", ["3"], test_crawl=False, levels=(2,))
+
+
+def test_dead_worksheet_links_do_not_fail_the_listing_page(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    site = FakeSite({LISTING: listing("add-fractions-with-like-denominators", "removed-worksheet"),
+                     WORKSHEET_BASE + "/add-fractions-with-like-denominators": worksheet()})
+    monkeypatch.setattr(splashLearn, "fetch", site)
+    catalog = catalog_module.Catalog("catalog.db")
+    catalog.add_pages([LISTING], 1, "3rd", "math")
+
+    extract(catalog)
+
+    assert catalog.pending_pages(1, "3rd", "math") == []
+    assert WORKSHEET_BASE + "/removed-worksheet" in catalog.done_pages(2, "3rd", "math")
+    assert catalog.worksheet_count("GRADE 3", "math") == 1
+    catalog.close()
+
+
+def test_transient_errors_fail_the_listing_page(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    site = FakeSite({LISTING: listing("add-fractions-with-like-denominators", "busy-worksheet"),
+                     WORKSHEET_BASE + "/add-fractions-with-like-denominators": worksheet()},
+                    {WORKSHEET_BASE + "/busy-worksheet": 503})
+    monkeypatch.setattr(splashLearn, "fetch", site)
+    catalog = catalog_module.Catalog("catalog.db")
+    catalog.add_pages([LISTING], 1, "3rd", "math")
+
+    extract(catalog)
+
+    assert catalog.pending_pages(1, "3rd", "math") == [LISTING]
+    assert WORKSHEET_BASE + "/busy-worksheet" not in catalog.done_pages(2, "3rd", "math")
+    catalog.close()
+
+
+def listing_site(last_page, statuses=None):
+    pages = {LISTING: listing("add-fractions-with-like-denominators")}
+    pages.update({f"{LISTING}/page/{page}": listing(f"worksheet-{page}") for page in range(2, last_page + 1)})
+    pages[WORKSHEET_BASE + "/add-fractions-with-like-denominators"] = worksheet()
+    return FakeSite(pages, statuses)
+
+
+def test_discovery_finds_the_last_listing_page_and_shares_its_links(monkeypatch):
+    site = listing_site(11)
+    monkeypatch.setattr(splashLearn, "fetch", site)
+    shared_pages = {}
+    pages = splashLearn.discover_listing_pages(LISTING, WORKSHEET_BASE, workers=4, shared_pages=shared_pages)
+    assert pages == [LISTING] + [f"{LISTING}/page/{page}" for page in range(2, 12)]
+    assert shared_pages[(f"{LISTING}/page/7", WORKSHEET_BASE)] == ({WORKSHEET_BASE + "/worksheet-7"}, None)
+    assert len(site.fetched) == len(set(site.fetched))
+
+
+def test_failed_probe_stops_discovery_without_storing_a_short_listing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    site = listing_site(40, {f"{LISTING}/page/8": 503})
+    del site.pages[f"{LISTING}/page/8"]
+    monkeypatch.setattr(splashLearn, "fetch", site)
+    catalog = catalog_module.Catalog("catalog.db")
+
+    splashLearn.collect_worksheets(catalog, CONFIG, "3rd", "math", ["3"], test_crawl=False, levels=(1,))
+
+    assert catalog.pages(1, "3rd", "math") == []
+    catalog.close()
+
+
+def test_l2_crawl_reuses_the_listing_pages_fetched_by_discovery(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    site = listing_site(3)
+    monkeypatch.setattr(splashLearn, "fetch", site)
+    catalog = catalog_module.Catalog("catalog.db")
+
+    splashLearn.collect_worksheets(catalog, CONFIG, "3rd", "math", ["3"], test_crawl=False)
+
+    assert catalog.pending_pages(1, "3rd", "math") == []
+    assert site.fetched.count(f"{LISTING}/page/2") == 1
+    assert site.fetched.count(LISTING) == 1
+    catalog.close()
+
+
+def test_queued_rerun_only_crawls_the_failed_listing_page(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = dict(CONFIG, queue={"enabled": 1, "batch": 1})
+    page_2 = f"{LISTING}/page/2"
+    site = FakeSite({LISTING: listing("add-fractions-with-like-denominators"), page_2: listing("busy-worksheet"),
+                     WORKSHEET_BASE + "/add-fractions-with-like-denominators": worksheet()},
+                    {WORKSHEET_BASE + "/busy-worksheet": 503})
+    monkeypatch.setattr(splashLearn, "fetch", site)
+    catalog = catalog_module.Catalog("catalog.db")
+    catalog.add_pages([LISTING, page_2], 1, "3rd", "math")
+
+    extract(catalog, config)
+    assert catalog.pending_pages(1, "3rd", "math") == [page_2]
+
+    site.pages[WORKSHEET_BASE + "/busy-worksheet"] = worksheet()
+    site.fetched = []
+    extract(catalog, config)
+
+    assert catalog.pending_pages(1, "3rd", "math") == []
+    assert LISTING not in site.fetched
+    assert page_2 in site.fetched
+    catalog.close()
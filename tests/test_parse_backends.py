@@ -0,0 +1,46 @@
+import os
+import json
+import pytest
+import splashLearn
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+WEBSITE = "https://www.splashlearn.com"
+WORKSHEET_BASE = WEBSITE + "/s/math-worksheets"
+PDF_BASE = WEBSITE + "/worksheet_uploads/pdf/s/"
+
+# Saved page -> the URL it was fetched from. Expected output is in parse_golden.json
+PAGES = {
+    "worksheet_page.html": WORKSHEET_BASE + "/add-fractions-with-like-denominators",
+    "worksheet_reordered_classes.html": WORKSHEET_BASE + "/area-of-rectangles",
+    "worksheet_other_grade.html": WORKSHEET_BASE + "/count-to-twenty",
+    "worksheet_no_topics.html": WORKSHEET_BASE + "/mixed-review",
+    "listing_page.html": WEBSITE + "/math-worksheets-for-3rd-graders",
+}
+
+
+def load_golden():
+    with open(os.path.join(FIXTURES, "parse_golden.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_fixture(name, backend):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as f:
+        html = f.read()
+    links, record = splashLearn.parse_page(html, PAGES[name], base_url=WORKSHEET_BASE, grade=["3"], pdf_base=PDF_BASE,
+                                           backend=backend)
+    return {"links": sorted(links), "record": json.loads(record) if record else None}
+
+
+@pytest.mark.parametrize("name", sorted(PAGES))
+@pytest.mark.parametrize("backend", ["bs4", "fast"])
+def test_backend_matches_golden_output(name, backend):
+    assert parse_fixture(name, backend) == load_golden()[name]
+
+
+@pytest.mark.parametrize("name", sorted(PAGES))
+def test_backends_produce_identical_records(name):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as f:
+        html = f.read()
+    bs4_output = splashLearn.parse_page(html, PAGES[name], base_url=WORKSHEET_BASE, grade=["3"], pdf_base=PDF_BASE, backend="bs4")
+    fast_output = splashLearn.parse_page(html, PAGES[name], base_url=WORKSHEET_BASE, grade=["3"], pdf_base=PDF_BASE, backend="fast")
+    assert fast_output == bs4_output
@@ -0,0 +1,92 @@
+import pytest
+import requests
+import request_layer
+
+
+class FakeSession:
+    """
+    Stands in for requests.Session: raises `error` on every request.
+    """
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        raise self.error
+
+
+def layer_with(session, tmp_path):
+    layer = request_layer.RequestLayer(initial_concurrency=2, requests_per_second=0, max_retries=2, backoff_base=0,
+                                       failure_queue=str(tmp_path / "failed.jsonl"))
+    layer.session = session
+    return layer
+
+
+@pytest.mark.parametrize("error", [requests.TooManyRedirects("loop"), requests.exceptions.InvalidURL("bad")])
+def test_final_errors_give_back_their_slot(tmp_path, error):
+    session = FakeSession(error)
+    layer = layer_with(session, tmp_path)
+    for _ in range(5):
+        with pytest.raises(type(error)):
+            layer.get("https://example.com/")
+    # Raised at once, without retries, and no slot is left taken
+    assert session.calls == 5
+    assert layer.limiter.in_flight == 0
+
+
+def test_chunked_encoding_errors_are_retried(tmp_path):
+    session = FakeSession(requests.exceptions.ChunkedEncodingError("cut off"))
+    layer = layer_with(session, tmp_path)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        layer.get("https://example.com/")
+    assert session.calls == 3
+    assert layer.limiter.in_flight == 0
+    assert (tmp_path / "failed.jsonl").exists()
+
+
+def pdf_response(body=b"%PDF-1.4 test", status=200):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response._content_consumed = True
+    return response
+
+
+class PdfSession:
+    """
+    Stands in for requests.Session: serves the same PDF for every URL.
+    """
+
+    def request(self, method, url, **kwargs):
+        return pdf_response(b"" if method == "HEAD" else b"%PDF-1.4 test")
+
+
+def test_replayed_pdfs_go_into_the_store(tmp_path, monkeypatch):
+    import splashLearn
+    monkeypatch.chdir(tmp_path)
+    layer = layer_with(PdfSession(), tmp_path)
+    layer.failures.record("GET", "https://example.com/a.pdf", "HTTP 503", 3, {"filepath": "a.pdf"})
+    monkeypatch.setattr(splashLearn, "http_layer", layer)
+
+    splashLearn.replay_failed_requests({"store": "store"})
+
+    import pdf_store
+    entry = pdf_store.PdfStore("store").lookup("https://example.com/a.pdf")
+    assert entry is not None
+    assert (tmp_path / "a.pdf").read_bytes() == b"%PDF-1.4 test"
+
+
+def test_streamed_responses_hold_their_slot_until_closed(tmp_path):
+    layer = layer_with(PdfSession(), tmp_path)
+    with layer.get("https://example.com/a.pdf", stream=True) as response:
+        assert layer.limiter.in_flight == 1
+        response.content
+    assert layer.limiter.in_flight == 0
+    # A second close does not free a slot twice
+    response.close()
+    assert layer.limiter.in_flight == 0
+
+    layer.get("https://example.com/a.pdf")
+    assert layer.limiter.in_flight == 0